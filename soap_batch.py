@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from soap_core import (
+    SECTION_HEADERS, CommitLog, build_log_aggregator, build_plan_text, format_staged_updates, iter_file_lines,
+    parse_and_merge_updates, parse_historical_soap, render_final_ap,
+)
+
+OUTPUT_NAME = "SOAP_AP_Final.txt"
+UNASSIGNED_TITLE = "New Problem: Unassigned orders"
+
+# =========================
+#  預先分類規則：藥物依狀態放 Current / Past，檢查類放 Exam，會診放 Consult
+# =========================
+def stage_category(item_type, item):
+    if item_type == 'other':
+        return "[Consult]" if "consult" in item['name'].casefold() else "[Exam]"
+    return "[Current Management]" if item['status'] == "Active" else "[Past treatment]"
+
+def match_problem(problems, item):
+    # 舊病歷已提到同一個藥名 / 檢查 (第一個字) 時，直接歸到該病名
+    word = item['name'].split(' ')[0].casefold()
+    if len(word) < 4: return None
+    return next((p for p in problems if word in p['full_content'].casefold()), None)
+
+def find_patient_files(patient_dir):
+    names = sorted(n for n in os.listdir(patient_dir) if n.lower().endswith('.txt') and n != OUTPUT_NAME)
+    soap_files = [n for n in names if n.lower().startswith('soap')]
+    log_files = [n for n in names if n.lower().startswith('log')]
+    return soap_files, log_files
+
+def draft_patient(patient_dir, formulary_data=None):
+    soap_files, log_files = find_patient_files(patient_dir)
+    soap_text = ""
+    if soap_files:
+        with open(os.path.join(patient_dir, soap_files[0]), encoding="utf-8") as f:
+            soap_text = f.read()
+    # Log 檔以 mmap 逐行讀取，不先把整個檔案讀成 bytes
+    log_sources = [iter_file_lines(os.path.join(patient_dir, name)) for name in log_files]
+
+    problems, hist_plan = parse_historical_soap(soap_text)
+    commit_log = CommitLog(problems)
+    final_meds, final_others = build_log_aggregator(log_sources, formulary_data, max_workers=1).results() if log_sources else ([], [])
+
+    groups = {}  # problem id (None = 新病名) -> staged
+    for item_type, items in (('med', final_meds), ('other', final_others)):
+        for item in items:
+            problem = match_problem(commit_log.problems, item)
+            staged = groups.setdefault(problem['id'] if problem else None, {sec: [] for sec in SECTION_HEADERS})
+            staged[stage_category(item_type, item)].append({'type': item_type, 'data': item})
+
+    commits = []
+    for commit_id, (problem_id, staged) in enumerate(groups.items(), start=1):
+        content = format_staged_updates(staged)
+        if problem_id is None:
+            title = UNASSIGNED_TITLE
+            commit_log.add_problem(commit_id, title, parse_and_merge_updates(UNASSIGNED_TITLE + "\n", content))
+        else:
+            title = commit_log.by_id[problem_id]['title']
+            commit_log.apply(commit_id, problem_id, content)
+        commits.append({'id': commit_id, 'title': title, 'content': content})
+
+    return render_final_ap(commit_log.final_text(), build_plan_text(hist_plan, commits))
+
+def run_patient(patient_dir, output_path, formulary_data=None):
+    text = draft_patient(patient_dir, formulary_data)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # 先寫暫存檔再 rename，中斷時不會留下半份輸出，續跑時可正確判斷是否完成
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate SOAP A/P drafts for every patient folder in a ward directory.")
+    parser.add_argument("input_dir", help="one sub-folder per patient, containing soap*.txt and log*.txt")
+    parser.add_argument("output_dir", help=f"drafts are written to <output_dir>/<patient>/{OUTPUT_NAME}")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--formulary", help="optional formulary.csv (canonical,alias1,alias2...)")
+    parser.add_argument("--force", action="store_true", help="regenerate drafts that already exist instead of resuming")
+    args = parser.parse_args(argv)
+
+    formulary_data = None
+    if args.formulary:
+        with open(args.formulary, 'rb') as f:
+            formulary_data = f.read()
+
+    patients = sorted(d for d in os.listdir(args.input_dir) if os.path.isdir(os.path.join(args.input_dir, d)))
+    jobs = {p: os.path.join(args.output_dir, p, OUTPUT_NAME) for p in patients}
+    pending = [p for p in patients if args.force or not os.path.exists(jobs[p])]
+    skipped = len(patients) - len(pending)
+
+    failures = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_patient, os.path.join(args.input_dir, p), jobs[p], formulary_data): p for p in pending}
+        for future in as_completed(futures):
+            patient = futures[future]
+            try:
+                future.result()
+                print(f"[OK]   {patient}")
+            except Exception as exc:
+                failures[patient] = exc
+                print(f"[FAIL] {patient}: {exc!r}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    done = len(pending) - len(failures)
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"{done} patients drafted in {elapsed:.2f}s ({rate:.1f} patients/s); "
+          f"{skipped} already done, {len(failures)} failed")
+    if failures:
+        print("Re-run the same command to resume the failed patients.", file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import sys
+import json
+import time
+import argparse
+import platform
+
+import soap_core
+from soap_synth import generate_log_lines, generate_soap, generate_update
+
+SIZES = [1000, 10000, 100000]
+
+# 每個 benchmark 先準備輸入 (不計時)，回傳的 run() 才是被量測的 stage
+def bench_parse_logs(n, seed):
+    lines = generate_log_lines(n, seed)
+    return lambda: soap_core.parse_logs_from_lines(lines)
+
+def bench_classify(n, seed):
+    entries = soap_core.parse_logs_from_lines(generate_log_lines(n, seed))
+    def run():
+        for entry in entries:
+            soap_core.classify_entry(entry)
+    return run
+
+def bench_process_logs(n, seed):
+    entries = soap_core.classify_entries(soap_core.parse_logs_from_lines(generate_log_lines(n, seed)))
+    return lambda: soap_core.process_logs(entries)
+
+def bench_parse_soap(n, seed):
+    # SOAP 大小：每 100 行 log 對應一個病名
+    soap_text = generate_soap(max(1, n // 100), seed)
+    return lambda: soap_core.parse_historical_soap(soap_text)
+
+def bench_merge(n, seed):
+    problems, _ = soap_core.parse_historical_soap(generate_soap(max(1, n // 100), seed))
+    updates = [generate_update(seed + i) for i in range(len(problems))]
+    def run():
+        for problem, update in zip(problems, updates):
+            soap_core.parse_and_merge_updates(problem['full_content'], update)
+    return run
+
+def bench_delete_commit(n, seed):
+    # n // 100 個 commit 平均分散在 10 個病名，撤銷最早的一筆 (最壞情況)
+    problems, _ = soap_core.parse_historical_soap(generate_soap(10, seed))
+    updates = [generate_update(seed + i) for i in range(max(1, n // 100))]
+    def run():
+        commit_log = soap_core.CommitLog(problems)
+        for commit_id, update in enumerate(updates, start=1):
+            commit_log.apply(commit_id, commit_log.problems[commit_id % len(problems)]['id'], update)
+        start = time.perf_counter()
+        commit_log.remove(1)
+        commit_log.final_text()
+        return time.perf_counter() - start
+    return run
+
+def bench_timeline(n, seed):
+    # 建立時間軸 + 每個列印時間點各查一次「使用中」與「前 24 小時異動」
+    entries = [e for e in soap_core.classify_entries(soap_core.parse_logs_from_lines(generate_log_lines(n, seed))) if e.is_med]
+    def run():
+        aggregator = soap_core.MedicationAggregator()
+        aggregator.add(entries)
+        timeline = aggregator.timeline
+        for ts in sorted({soap_core.timestamp_to_int(e.timestamp) for e in entries})[::10]:
+            timeline.active_at(ts)
+            timeline.changed_since(soap_core.shift_timestamp(ts, -24), ts)
+    return run
+
+BENCHMARKS = {
+    "parse_logs_from_lines": bench_parse_logs,
+    "classify_entry": bench_classify,
+    "process_logs": bench_process_logs,
+    "parse_historical_soap": bench_parse_soap,
+    "parse_and_merge_updates": bench_merge,
+    "delete_commit_replay": bench_delete_commit,
+    "medication_timeline": bench_timeline,
+}
+
+def clear_caches():
+    soap_core.normalize_drug_name.cache_clear()
+    soap_core.timestamp_to_int.cache_clear()
+    soap_core.parse_problem.cache_clear()
+
+def time_stage(run, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        inner = run()
+        elapsed = time.perf_counter() - start
+        # run 若自行回傳秒數，表示只量測其中一段 (例如撤銷本身，不含建立 commit)
+        best = min(best, inner if isinstance(inner, float) else elapsed)
+    return best
+
+def run_benchmarks(sizes, names, repeat, seed):
+    results = {}
+    for name in names:
+        for n in sizes:
+            run = BENCHMARKS[name](n, seed)
+            results[f"{name}@{n}"] = time_stage(run, repeat)
+            print(f"{name:<26} {n:>7} lines  {results[f'{name}@{n}'] * 1000:10.2f} ms", flush=True)
+    return results
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'benchmark':<36} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for key, current in results.items():
+        if key not in baseline: continue
+        ratio = current / baseline[key] if baseline[key] > 0 else float("inf")
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{key:<36} {baseline[key] * 1000:9.2f}ms {current * 1000:9.2f}ms {ratio:6.2f}x{flag}")
+        if flag: regressions.append(key)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each SOAP pipeline stage on synthetic inputs of increasing size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="log sizes in lines (default: 1k 10k 100k)")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run a subset of the stages")
+    parser.add_argument("--repeat", type=int, default=3, help="best-of-N timing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON for later comparison")
+    parser.add_argument("--compare", help="baseline JSON written by --output")
+    parser.add_argument("--threshold", type=float, default=1.25, help="ratio above which a stage counts as a regression")
+    args = parser.parse_args(argv)
+
+    names = args.only or list(BENCHMARKS)
+    results = run_benchmarks(args.sizes, names, args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                         "seed": args.seed, "repeat": args.repeat, "created": time.strftime("%Y-%m-%d %H:%M:%S")},
+                "results": results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1331 @@
+import re
+import io
+import csv
+import os
+import sys
+import heapq
+import bisect
+import codecs
+import gc
+import json
+import time
+import hashlib
+import functools
+import itertools
+import logging
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+from array import array
+from datetime import datetime, timedelta
+from types import MappingProxyType, ModuleType, FunctionType, BuiltinFunctionType, MethodType
+from collections import OrderedDict, deque
+
+# =========================
+#  效能量測：各 stage 的耗時與記憶體峰值 (只在啟用 profiler 時量測)
+# =========================
+PROFILE_LOGGER = logging.getLogger("soap_core.profile")
+_active_profiler = contextvars.ContextVar("soap_profiler", default=None)
+
+# tracemalloc 是整個 process 共用的：以 refcount 記錄進行中的 stage，
+# 只在沒有其他 stage 進行時才 reset_peak，最後一個 stage 結束後才停止追蹤
+_tracing_lock = threading.Lock()
+_tracing_stages = 0
+_tracing_started = False
+
+def _begin_traced_stage():
+    global _tracing_stages, _tracing_started
+    with _tracing_lock:
+        if _tracing_stages == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing_started = True
+            tracemalloc.reset_peak()
+        _tracing_stages += 1
+        return tracemalloc.get_traced_memory()[0]
+
+def _end_traced_stage():
+    global _tracing_stages, _tracing_started
+    with _tracing_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracing_stages -= 1
+        if _tracing_stages == 0 and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+        return peak
+
+class StageProfiler:
+    def __init__(self, trace_memory=True, max_records=200, logger=PROFILE_LOGGER):
+        self.trace_memory = trace_memory
+        self.records = deque(maxlen=max_records)
+        self.logger = logger
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        # 同時有其他 stage (其他 session 或巢狀) 進行時，peak_kb 是整個 process 在這段期間的峰值
+        record = {"stage": name, **fields}
+        if self.trace_memory:
+            base = _begin_traced_stage()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            if self.trace_memory:
+                record["peak_kb"] = round(max(0, _end_traced_stage() - base) / 1024, 1)
+            self.records.append(record)
+            self.logger.info(json.dumps(record, ensure_ascii=False), extra={"soap_stage": record})
+
+    def clear(self):
+        self.records.clear()
+
+def activate_profiler(profiler):
+    return _active_profiler.set(profiler)
+
+def active_profiler():
+    return _active_profiler.get()
+
+def profile_stage(name, **fields):
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.stage(name, **fields)
+
+# 物件圖的實際大小：共用的物件只算一次 (同一個 seen 可跨多次呼叫，用來扣掉已算過的部分)
+MEMORY_SKIP_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType)
+
+def deep_sizeof(obj, seen=None):
+    seen = set() if seen is None else seen
+    total = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, MEMORY_SKIP_TYPES):
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        pending.extend(gc.get_referents(current))
+    return total
+
+# 病名 / 醫囑 / 購物車項目皆為唯讀 record：commit 與各清單直接共用同一份，不需複製
+def record(**fields):
+    return MappingProxyType(fields)
+
+# =========================
+#  基礎資料結構與解析邏輯
+# =========================
+ACTION_CODES = ('Active', 'NEW', 'DC', 'DC-D', 'DC-C', 'DC-E', 'CHG', 'EXTN')
+ACTION_INDEX = {code: i for i, code in enumerate(ACTION_CODES)}
+
+class LogEntry:
+    __slots__ = ('timestamp', 'raw_line', 'name', 'details', 'action', 'notes', 'is_med', 'feature')
+
+    def __init__(self, timestamp, raw_line):
+        self.timestamp = timestamp
+        self.raw_line = raw_line
+        self.name = ""
+        self.details = ""
+        self.action = "Active"
+        self.notes = ()
+        self.is_med = False
+        self.feature = None
+
+    def add_note(self, note):
+        self.notes = self.notes + (note,)
+
+# 欄位式儲存 (columnar)：大量 entry 的批次處理不需保留每筆物件
+class EntryTable:
+    __slots__ = ('timestamps', 'raw_lines', 'names', 'actions', 'notes', 'is_med', 'features')
+
+    def __init__(self):
+        self.timestamps = []
+        self.raw_lines = []
+        self.names = []
+        self.actions = array('B')
+        self.notes = []
+        self.is_med = bytearray()
+        self.features = []
+
+    @classmethod
+    def from_entries(cls, entries):
+        table = cls()
+        for entry in entries:
+            table.append(entry)
+        return table
+
+    def append(self, entry):
+        self.timestamps.append(entry.timestamp)
+        self.raw_lines.append(entry.raw_line)
+        self.names.append(entry.name)
+        self.actions.append(ACTION_INDEX[entry.action])
+        self.notes.append(entry.notes or None)
+        self.is_med.append(entry.is_med)
+        self.features.append(entry.feature)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        entry = LogEntry(self.timestamps[i], self.raw_lines[i])
+        entry.name = entry.details = self.names[i]
+        entry.action = ACTION_CODES[self.actions[i]]
+        entry.notes = self.notes[i] or ()
+        entry.is_med = bool(self.is_med[i])
+        entry.feature = self.features[i]
+        return entry
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def iter_stream_lines(stream, encoding="utf-8", chunk_size=1 << 16):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk: break
+        pending += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        *complete, pending = pending.split('\n')
+        yield from complete
+    yield pending + decoder.decode(b"", final=True)
+
+def iter_file_lines(path, encoding="utf-8"):
+    import mmap
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield ""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter_stream_lines(mm, encoding)
+
+PRINT_TIME_RE = re.compile(r'列印時間:(\d{4}/\d{2}/\d{2} \d{2}:\d{2})')
+
+# 逐行解析並以 generator 輸出：下一筆醫囑出現 (或輸入結束) 時，上一筆才算完整
+def iter_log_entries(lines):
+    current_time = None
+    last_entry = None
+    last_parts = []
+
+    def finish(entry, parts):
+        if len(parts) > 1:
+            entry.name = entry.details = " ".join(parts)
+        return entry
+
+    for raw in lines:
+        raw = raw.rstrip('\n')
+        stripped = raw.strip()
+        time_match = PRINT_TIME_RE.search(raw)
+        if time_match:
+            current_time = sys.intern(time_match.group(1))
+            continue
+        if not stripped or "類別" in raw or "醫師:" in raw: continue
+        parts = stripped.split()
+        if parts and parts[0] in ACTION_INDEX and parts[0] != 'Active':
+            action = ACTION_CODES[ACTION_INDEX[parts[0]]]
+            content = stripped[len(action):].strip()
+            entry = LogEntry(current_time, raw)
+            entry.action = action
+            entry.name = entry.details = content
+            if last_entry: yield finish(last_entry, last_parts)
+            last_entry, last_parts = entry, [content]
+            continue
+        if stripped.startswith('(') or stripped.startswith('..'):
+            if last_entry: last_entry.add_note(stripped)
+            continue
+        if last_entry and raw.startswith(' '):
+            if not re.search(r'\*:EMR|BLOOD GAS|EKG|Consult', stripped, re.I):
+                if not re.search(r'\b(B|U|S|BV)\b', stripped):
+                    last_parts.append(stripped)
+                    continue
+        entry = LogEntry(current_time, raw)
+        entry.name = entry.details = stripped
+        if last_entry: yield finish(last_entry, last_parts)
+        last_entry, last_parts = entry, [stripped]
+    if last_entry: yield finish(last_entry, last_parts)
+
+def parse_logs_from_lines(lines):
+    return list(iter_log_entries(lines))
+
+# 檢體 (B/U/S/BV) 優先判定為非藥物；藥物特徵合併為單一 pattern。
+# 兩者都是遇到第一個命中就停止的 search，比逐一比對或整行 finditer 快
+SPECIMEN_RE = re.compile(r'\b(?:BV?|U|S)\b')
+MED_FEATURE_RE = re.compile(
+    r'\b(?:Q\d+[HM]|QD|BID|TID|QID|ONCE|PRN|IVF?|PO|TOPI)\b'
+    r'|\d+(?:mg|g|gm|ml|mcg|vial|tab|amp|cap|iu)\b',
+    re.IGNORECASE
+)
+
+def match_med_feature(text):
+    specimen = SPECIMEN_RE.search(text)
+    if specimen:
+        return False, specimen.group()
+    med_hit = MED_FEATURE_RE.search(text)
+    return med_hit is not None, med_hit.group() if med_hit else None
+
+def classify_entry(entry):
+    if entry.name.startswith('.'):
+        entry.is_med, entry.feature = False, None
+        return entry
+    text = entry.details + " " + " ".join(entry.notes)
+    entry.is_med, entry.feature = match_med_feature(text)
+    return entry
+
+def classify_entries(entries):
+    for entry in entries:
+        classify_entry(entry)
+    return entries
+
+def iter_classified(entries):
+    for entry in entries:
+        yield classify_entry(entry)
+
+# =========================
+#  多檔平行解析：每個檔案各自的列印時間 context，最後依時間合併
+# =========================
+def entry_time_key(entry):
+    return entry.timestamp or ""
+
+# 增量匯入：列印時間早於 high-water mark 的整個列印區塊在進入解析前就略過。
+# 與 high-water 同一分鐘的區塊仍會重新解析 (可能是同一分鐘的另一份列印)；重複加入不影響彙整結果
+def iter_lines_since(lines, since):
+    keep = True
+    for raw in lines:
+        if '列印時間' in raw:
+            time_match = PRINT_TIME_RE.search(raw)
+            if time_match:
+                keep = timestamp_to_int(time_match.group(1)) >= since
+        if keep:
+            yield raw
+
+EMPTY_DIGESTS = array('q')
+# 醫囑的起點：與 iter_log_entries 一致，縮排行、(...) 與 .. 備註都歸屬前一筆醫囑
+RECORD_BOUNDARY_RE = re.compile(r'\n(?![\s(]|\.\.|\Z)')
+
+# 重複列印去除：同一列印時間下，區塊開頭若與先前已送出的醫囑結尾依序相同 (同一份列印重複上傳、
+# 累積報表重印舊區塊) 就略過這一段；整個區塊都是重印時連標頭一起略過。只略過這種重疊段，
+# 最終狀態才會與不去重時相同 (同一分鐘內 DC 後再 NEW 的 NEW 不能因為「收過」就丟掉)。
+# 不同列印時間的相同醫囑一律保留。狀態只存 hash，不保留原始行
+class LogDeduplicator:
+    def __init__(self):
+        # 列印時間 -> 已送出醫囑的 hash (依送出順序的 array('q')，更新時換成新的一份，copy 只需淺複製 dict)；
+        # 只在同一列印時間內比對，hash 碰撞的機率可忽略
+        self.records_by_time = {}
+        self.skipped_lines = 0
+
+    def copy(self):
+        clone = LogDeduplicator()
+        clone.records_by_time = dict(self.records_by_time)
+        clone.skipped_lines = self.skipped_lines
+        return clone
+
+    def filter(self, lines):
+        block = []
+        for raw in lines:
+            if '列印時間' in raw and PRINT_TIME_RE.search(raw):
+                yield from self._unique_block(block)
+                block = []
+            block.append(raw)
+        yield from self._unique_block(block)
+
+    def _unique_block(self, block):
+        if not block:
+            return
+        time_match = PRINT_TIME_RE.search(block[0])
+        start = 1 if time_match else 0
+        print_time = time_match.group(1) if time_match else None
+        orders = RECORD_BOUNDARY_RE.split("\n".join(block[start:])) if start < len(block) else []
+        digests = array('q', map(hash, orders))
+        seen = self.records_by_time.get(print_time, EMPTY_DIGESTS)
+        overlap = reprinted_prefix(seen, digests)
+        if seen and overlap == len(orders):
+            self.skipped_lines += len(block)
+            return
+        self.records_by_time[print_time] = seen + digests[overlap:]
+        self.skipped_lines += sum(order.count('\n') + 1 for order in orders[:overlap])
+        # 列印時間標頭一律保留：部分重印時若連標頭一起略過，留下的醫囑會失去時間
+        if not overlap:
+            yield from block
+            return
+        yield from block[:start]
+        for order in orders[overlap:]:
+            yield from order.split('\n')
+
+def reprinted_prefix(seen, digests):
+    # 最長的 k：本區塊前 k 筆醫囑與同一列印時間最後送出的 k 筆依序相同
+    for k in range(min(len(seen), len(digests)), 0, -1):
+        if seen[len(seen) - k] == digests[0] and seen[len(seen) - k:] == digests[:k]:
+            return k
+    return 0
+
+def iter_source_lines(source, since=None):
+    if isinstance(source, str):
+        lines = iter(source.split('\n'))
+    elif isinstance(source, (bytes, bytearray)):
+        lines = iter_stream_lines(io.BytesIO(source))
+    else:
+        lines = iter(source)  # 已切好的行 (例如去重後的結果)
+    return lines if since is None else iter_lines_since(lines, since)
+
+def parse_log_source(source, since=None):
+    entries = sorted(iter_classified(iter_log_entries(iter_source_lines(source, since))), key=entry_time_key)
+    return EntryTable.from_entries(entries)
+
+def parse_log_sources(sources, max_workers=None, since=None):
+    if len(sources) == 1:
+        return iter_classified(iter_log_entries(iter_source_lines(sources[0], since)))
+    tables = None
+    if len(sources) > 1 and max_workers != 1:
+        # multiprocessing 相關模組只在真的需要平行解析時才載入，讓 worker / script 啟動更快
+        import pickle
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            workers = max_workers or min(len(sources), os.cpu_count() or 1)
+            # Streamlit server 是多執行緒的，在其中 fork 可能死結；改用 forkserver (不支援時用 spawn)
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+                tables = list(pool.map(parse_log_source, sources, [since] * len(sources)))
+        except (OSError, NotImplementedError, AttributeError, pickle.PicklingError, BrokenProcessPool):
+            tables = None
+    if tables is None:
+        tables = [parse_log_source(source, since) for source in sources]
+    return heapq.merge(*tables, key=entry_time_key)
+
+# =========================
+#  藥名正規化 (LRU 快取) 與處方集 / 別名對照
+# =========================
+WIDE_GAP_RE = re.compile(r'\s{2,}')
+TUBE_RE = re.compile(r'\(管\d+\)')
+DOSE_RE = re.compile(r'\b\d+(\.\d+)?\s*(mg|g|gm|mL|ml|mcg|mEq|vial|tab|amp|cap|iu)(/[A-Za-z]+)*\b', re.IGNORECASE)
+TRAILING_COMMA_RE = re.compile(r',\s*(?=\s|$)')
+SPACES_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=4096)
+def normalize_drug_name(name):
+    name = WIDE_GAP_RE.split(name)[0]
+    name = TUBE_RE.sub('', name)
+    name = DOSE_RE.sub('', name)
+    name = TRAILING_COMMA_RE.sub('', name)
+    return SPACES_RE.sub(' ', name).strip().title()
+
+def normalization_cache_stats():
+    info = normalize_drug_name.cache_info()
+    total = info.hits + info.misses
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+            "hit_rate": info.hits / total if total else 0.0}
+
+class DrugFormulary:
+    def __init__(self, aliases=None):
+        self.exact = {}
+        for alias, canonical in (aliases or {}).items():
+            self.add(alias, canonical)
+
+    @classmethod
+    def from_lines(cls, lines):
+        # 每行：標準藥名,別名1,別名2,...
+        formulary = cls()
+        for row in csv.reader(lines):
+            names = [n.strip() for n in row if n.strip()]
+            if not names or names[0].startswith('#'): continue
+            for alias in names:
+                formulary.add(alias, names[0])
+        return formulary
+
+    def add(self, alias, canonical):
+        key = normalize_drug_name(alias).casefold()
+        if key: self.exact[key] = canonical
+
+    def lookup(self, normalized_name):
+        words = normalized_name.casefold().split(' ')
+        for n in range(len(words), 0, -1):
+            canonical = self.exact.get(' '.join(words[:n]))
+            if canonical is not None:
+                return canonical
+        return None
+
+    def __len__(self):
+        return len(self.exact)
+
+def drug_key(name, formulary=None):
+    normalized = normalize_drug_name(name)
+    if formulary:
+        return formulary.lookup(normalized) or normalized
+    return normalized
+
+# =========================
+#  醫囑狀態彙整 (增量)：每個藥名只保留最後一筆動作
+# =========================
+NO_TIMESTAMP = -1  # 無列印時間的醫囑視為最早，任何有時間的醫囑都會覆蓋它
+
+@functools.lru_cache(maxsize=1024)
+def timestamp_to_int(timestamp):
+    if not timestamp: return NO_TIMESTAMP
+    return int(timestamp.replace('/', '').replace(' ', '').replace(':', ''))
+
+def int_to_datetime(ts):
+    return None if ts == NO_TIMESTAMP else datetime.strptime(str(ts), "%Y%m%d%H%M")
+
+def datetime_to_int(dt):
+    return int(dt.strftime("%Y%m%d%H%M"))
+
+def shift_timestamp(ts, hours):
+    return datetime_to_int(int_to_datetime(ts) + timedelta(hours=hours))
+
+def format_timestamp(ts):
+    return "(無列印時間)" if ts == NO_TIMESTAMP else int_to_datetime(ts).strftime("%Y/%m/%d %H:%M")
+
+def is_active_action(action):
+    return action is not None and not action.startswith("DC")
+
+# 用藥時間軸：每個藥名一組依時間排序的 array (時間 int + 動作代碼)，區間查詢用 bisect
+class MedicationTimeline:
+    def __init__(self):
+        self.times = {}    # drug key -> array('q')，timestamp_to_int 的值，遞增
+        self.actions = {}  # drug key -> array('B')，ACTION_CODES 的 index
+        self.events = 0
+
+    def add(self, key, ts, action_code):
+        times = self.times.get(key)
+        if times is None:
+            self.times[key] = array('q', (ts,))
+            self.actions[key] = array('B', (action_code,))
+            self.events += 1
+            return
+        actions = self.actions[key]
+        # log 大多依時間到達，直接接在尾端；較舊的追加 log 才需要二分插入
+        i = len(times) if ts >= times[-1] else bisect.bisect_right(times, ts)
+        if i and times[i - 1] == ts and actions[i - 1] == action_code:
+            return  # 同時間同動作：同一筆醫囑在不同列印中重複出現
+        if i == len(times):
+            times.append(ts)
+            actions.append(action_code)
+        else:
+            times.insert(i, ts)
+            actions.insert(i, action_code)
+        self.events += 1
+
+    def copy(self):
+        clone = MedicationTimeline()
+        clone.times = {key: times[:] for key, times in self.times.items()}
+        clone.actions = {key: actions[:] for key, actions in self.actions.items()}
+        clone.events = self.events
+        return clone
+
+    def status_at(self, key, ts):
+        times = self.times.get(key)
+        if not times:
+            return None
+        i = bisect.bisect_right(times, ts)
+        return ACTION_CODES[self.actions[key][i - 1]] if i else None
+
+    def active_at(self, ts):
+        return sorted(key for key in self.times if is_active_action(self.status_at(key, ts)))
+
+    def changed_since(self, start, end=None):
+        # (start, end] 之間有 NEW / DC / CHG 等動作的藥名 (單純列出的 Active 不算異動)
+        changed = []
+        for key, times in self.times.items():
+            if times[-1] <= start:
+                continue
+            lo = bisect.bisect_right(times, start)
+            hi = len(times) if end is None else bisect.bisect_right(times, end)
+            if any(self.actions[key][lo:hi]):
+                changed.append(key)
+        return sorted(changed)
+
+    def history(self, key):
+        return [(ts, ACTION_CODES[code]) for ts, code in zip(self.times.get(key, ()), self.actions.get(key, ()))]
+
+def med_sort_key(item):
+    return (item["status"] != "Active", item["name"])
+
+def other_sort_key(item):
+    return (item["name"],)
+
+def same_order(entry, other):
+    return entry.action == other.action and entry.details == other.details
+
+class MedicationAggregator:
+    def __init__(self, formulary=None):
+        self.formulary = formulary
+        self.latest_meds = {}    # drug key -> (int timestamp, LogEntry)
+        self.latest_others = {}  # clean title -> (int timestamp, LogEntry)
+        self.dedup = LogDeduplicator()
+        self.timeline = MedicationTimeline()
+
+    def add(self, entries):
+        changed_meds, changed_others = set(), set()
+        for entry in entries:
+            if entry.is_med:
+                key = drug_key(entry.name, self.formulary)
+                ts = timestamp_to_int(entry.timestamp)
+                self.timeline.add(key, ts, ACTION_INDEX[entry.action])
+                current = self.latest_meds.get(key)
+                # 同時間者以後到的為準 (等同原本 stable sort 取最後一筆)；
+                # 內容完全相同 (例如續傳時重新解析 high-water 那一分鐘) 不算變動
+                if current is None or ts >= current[0]:
+                    if current is None or ts != current[0] or not same_order(entry, current[1]):
+                        changed_meds.add(key)
+                    self.latest_meds[key] = (ts, entry)
+            else:
+                clean_other = WIDE_GAP_RE.split(entry.name)[0].strip()
+                if clean_other and clean_other != '.' and len(clean_other) > 2:
+                    clean_title = clean_other.title()
+                    ts = timestamp_to_int(entry.timestamp)
+                    current = self.latest_others.get(clean_title)
+                    # 與藥物相同：較舊的 log 晚到 (追加上傳) 時不可蓋過較新的一筆
+                    if current is None or ts >= current[0]:
+                        if current is None or ts != current[0] or not same_order(entry, current[1]):
+                            changed_others.add(clean_title)
+                        self.latest_others[clean_title] = (ts, entry)
+        return changed_meds, changed_others
+
+    def med_item(self, drug):
+        last = self.latest_meds[drug][1]
+        status = "Discontinued" if last.action.startswith("DC") else "Active"
+        display_str = f"[{'Add' if status == 'Active' else 'DC'}] {drug}"
+        return record(name=drug, status=status, display=display_str, details=last.details)
+
+    def other_item(self, clean_name):
+        return record(name=clean_name, display=clean_name, details=self.latest_others[clean_name][1].details)
+
+    def high_water(self):
+        # 全部醫囑中時間最晚的一筆必定還留在彙整結果裡，因此只需看保留的 entry
+        return max(itertools.chain(
+            (ts for ts, _ in self.latest_meds.values()),
+            (ts for ts, _ in self.latest_others.values()),
+        ), default=NO_TIMESTAMP)
+
+    def copy(self):
+        clone = MedicationAggregator(self.formulary)
+        clone.latest_meds = dict(self.latest_meds)
+        clone.latest_others = dict(self.latest_others)
+        clone.dedup = self.dedup.copy()
+        clone.timeline = self.timeline.copy()
+        return clone
+
+    def results(self):
+        final_meds = [self.med_item(drug) for drug in self.latest_meds]
+        final_meds.sort(key=med_sort_key)
+        final_others = [self.other_item(name) for name in self.latest_others]
+        final_others.sort(key=other_sort_key)
+        return final_meds, final_others
+
+def process_logs(entries, formulary=None):
+    aggregator = MedicationAggregator(formulary)
+    aggregator.add(entries)
+    return aggregator.results()
+
+# 未分配醫囑池：以名稱為 key 的索引 + 排序好的 key list (bisect 插入)，點擊不需整串掃描或重新排序
+class OrderPool:
+    def __init__(self, items=(), sort_key=other_sort_key):
+        self.sort_key = sort_key
+        self.by_name = {}
+        self.order = []   # sort_key(item) 排序；sort key 皆含 name，不會重複
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self.discard(item['name'])
+        self.by_name[item['name']] = item
+        bisect.insort(self.order, self.sort_key(item))
+
+    def discard(self, name):
+        item = self.by_name.pop(name, None)
+        if item is not None:
+            key = self.sort_key(item)
+            del self.order[bisect.bisect_left(self.order, key)]
+        return item
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __iter__(self):
+        for key in self.order:
+            yield self.by_name[key[-1]]
+
+    def matching(self, query=""):
+        query = query.strip().casefold()
+        if not query:
+            return iter(self)
+        return (item for item in self if query in item['display'].casefold())
+
+# 歷史 SOAP 分段：一次掃描找出 A:/P: 標記與各病名起點，每個病名記下編號與段落 offset。
+# 規則與原本的 DOTALL regex 相同：A 段取第一個 A: 到其後第一個 P:，P 段取第一個 P: 到結尾
+SOAP_MARKER_RE = re.compile(r'^\s*(?:(A)|P)\s*:', re.MULTILINE | re.IGNORECASE)
+PROBLEM_START_RE = re.compile(r'^\d+\.\s', re.MULTILINE)
+PROBLEM_NUMBER_RE = re.compile(r'(\d+)\.')
+
+def parse_historical_soap(soap_text):
+    a_start = a_end = p_start = None
+    for m in SOAP_MARKER_RE.finditer(soap_text):
+        if m.group(1):
+            if a_start is None: a_start = m.end()
+            continue
+        if p_start is None: p_start = m.end()
+        if a_start is not None:
+            a_end = m.start()
+            break
+
+    a_text = soap_text[a_start:a_end].strip() if a_start is not None else ""
+    p_text = soap_text[p_start:].strip() if p_start is not None else ""
+
+    problems = []
+    if a_text:
+        starts = [m.start() for m in PROBLEM_START_RE.finditer(a_text)]
+        bounds = ([0] if not starts or starts[0] else []) + starts + [len(a_text)]
+        for start, end in zip(bounds, bounds[1:]):
+            item = a_text[start:end].strip()
+            if item:
+                title_line = item.split('\n', 1)[0].strip()
+                number = PROBLEM_NUMBER_RE.match(title_line)
+                problems.append(record(
+                    title=title_line, full_content=item, number=int(number.group(1)) if number else None,
+                ))
+    return problems, p_text
+
+# =========================
+#  智慧合併引擎 (Smart Merge) - 置底插入
+# =========================
+SECTION_HEADERS = ["[Exam]", "[Past treatment]", "[Current Management]", "[Consult]"]
+SECTION_NAMES_PATTERN = '|'.join(f'(?P<s{i}>{re.escape(sec.strip("[]"))})' for i, sec in enumerate(SECTION_HEADERS))
+SECTION_HEADER_RE = re.compile(r'\[\s*(?:' + SECTION_NAMES_PATTERN + r')\s*\]', re.IGNORECASE)
+# 結尾若是未閉合的 [ 或 [名稱，與後段文字相接時可能拼出新的段落標頭
+OPEN_HEADER_RE = re.compile(r'\[\s*(?:' + SECTION_NAMES_PATTERN.replace('?P<s', '?P<o') + r')?\Z', re.IGNORECASE)
+NEXT_SECTION_RE = re.compile(r'\n\s*\[')
+LINE_START_BRACKET_RE = re.compile(r'(?:^|\n)\s*\[')
+
+def split_update_sections(edited_updates):
+    sections = {sec: [] for sec in SECTION_HEADERS}
+    current_sec = None
+    
+    for line in edited_updates.split('\n'):
+        stripped = line.strip()
+        if stripped in sections:
+            current_sec = stripped
+        elif current_sec and stripped:
+            sections[current_sec].append(line)
+    return {sec: "\n".join(lines) for sec, lines in sections.items() if lines}
+
+def merge_sections_sequential(base_text, blocks):
+    result_text = base_text
+    for sec, block in blocks.items():
+        pattern_start = r'\[\s*' + re.escape(sec.strip('[]')) + r'\s*\]'
+        match_start = re.search(pattern_start, result_text, re.IGNORECASE)
+        
+        if match_start:
+            start_pos = match_start.end()
+            match_next = re.search(r'\n\s*\[', result_text[start_pos:])
+            if match_next:
+                insert_pos = start_pos + match_next.start()
+                result_text = result_text[:insert_pos].rstrip() + "\n" + block + "\n\n" + result_text[insert_pos:].lstrip()
+            else:
+                result_text = result_text.rstrip() + "\n" + block + "\n"
+        else:
+            result_text = result_text.rstrip() + f"\n\n{sec}\n{block}\n"
+    return result_text
+
+# 病名段落索引：一次掃描記下各段落標頭與其後的插入點，之後的合併只需重組一次字串
+class ParsedProblem:
+    def __init__(self, text):
+        self.text = text
+        boundaries = [m.start() for m in NEXT_SECTION_RE.finditer(text)]
+        self.insert_points = {}  # section -> 插入點 (下一個 [ 前的換行)；None 表示段落在結尾
+        self.spans = {}          # section -> (段落內容起點, 終點)
+        for m in SECTION_HEADER_RE.finditer(text):
+            sec = SECTION_HEADERS[int(m.lastgroup[1:])]
+            if sec in self.insert_points: continue
+            i = bisect.bisect_left(boundaries, m.end())
+            self.insert_points[sec] = boundaries[i] if i < len(boundaries) else None
+            self.spans[sec] = (m.end(), boundaries[i] if i < len(boundaries) else len(text))
+
+    def merge(self, edited_updates):
+        if not edited_updates.strip():
+            return self.text
+        return self.merge_blocks(split_update_sections(edited_updates))
+
+    def merge_blocks(self, blocks):
+        text = self.text
+        at_points = {}
+        tail_found, tail_new = [], []  # 依段落順序：(順序, block)
+        for order, (sec, block) in enumerate(blocks.items()):
+            if LINE_START_BRACKET_RE.search(block) or SECTION_HEADER_RE.search(block) or OPEN_HEADER_RE.search(block.rstrip()):
+                return merge_sections_sequential(text, blocks)
+            if sec not in self.insert_points:
+                tail_new.append((order, f"\n\n{sec}\n", block))
+            elif self.insert_points[sec] is None:
+                tail_found.append((order, block))
+            else:
+                at_points.setdefault(self.insert_points[sec], []).append(block)
+
+        parts = []
+        pos = 0
+        for point in sorted(at_points):
+            left = text[pos:point].rstrip()
+            if OPEN_HEADER_RE.search(left):
+                return merge_sections_sequential(text, blocks)
+            point_blocks = at_points[point]
+            parts.append(left)
+            parts.extend("\n" + block.rstrip() for block in point_blocks[:-1])
+            parts.append("\n" + point_blocks[-1] + "\n\n")
+            pos = point + len(text[point:]) - len(text[point:].lstrip())
+
+        tail = text[pos:]
+        if not tail_found and not tail_new:
+            parts.append(tail)
+            return "".join(parts)
+        tail = tail.rstrip()
+        if OPEN_HEADER_RE.search(tail):
+            return merge_sections_sequential(text, blocks)
+        parts.append(tail)
+        # 新段落標頭會成為後續既有段落的插入點；最後一個 block 之後不再被 rstrip
+        keep_last_found = not tail_new or (tail_found and tail_found[-1][0] > tail_new[0][0])
+        for i, (_, block) in enumerate(tail_found):
+            is_last = i == len(tail_found) - 1
+            parts.append("\n" + (block if is_last and keep_last_found else block.rstrip()))
+        for i, (_, header, block) in enumerate(tail_new):
+            parts.append(header + (block if i == len(tail_new) - 1 else block.rstrip()))
+        parts.append("\n")
+        return "".join(parts)
+
+@functools.lru_cache(maxsize=256)
+def parse_problem(text):
+    return ParsedProblem(text)
+
+def parse_and_merge_updates(base_text, edited_updates):
+    return parse_problem(base_text).merge(edited_updates)
+
+# =========================
+#  Commit 紀錄：每個病名各自的 commit log + 定期 snapshot，撤銷時只重播該病名
+# =========================
+NUMBER_PREFIX_RE = re.compile(r'^\d+\.\s*')
+
+def render_problem_body(content):
+    return NUMBER_PREFIX_RE.sub('', content.strip())
+
+class ProblemHistory:
+    def __init__(self, base_content, snapshot_every):
+        self.snapshot_every = snapshot_every
+        self.updates = []                 # [(commit_id, content)]
+        self.snapshots = [base_content]   # snapshots[k] = 套用前 k * snapshot_every 筆後的內容
+        self.content = base_content
+
+    def apply(self, commit_id, content):
+        self.content = parse_and_merge_updates(self.content, content)
+        self.updates.append((commit_id, content))
+        if len(self.updates) % self.snapshot_every == 0:
+            self.snapshots.append(self.content)
+        return self.content
+
+    def remove(self, commit_id):
+        idx = next(i for i, (cid, _) in enumerate(self.updates) if cid == commit_id)
+        del self.updates[idx]
+        del self.snapshots[idx // self.snapshot_every + 1:]
+        start = (len(self.snapshots) - 1) * self.snapshot_every
+        self.content = self.snapshots[-1]
+        for i in range(start, len(self.updates)):
+            self.content = parse_and_merge_updates(self.content, self.updates[i][1])
+            if (i + 1) % self.snapshot_every == 0:
+                self.snapshots.append(self.content)
+        return self.content
+
+class CommitLog:
+    def __init__(self, problems, snapshot_every=8):
+        self.snapshot_every = snapshot_every
+        self.problems = []        # 與 st.session_state.hist_probs 共用同一個 list
+        self.by_id = {}
+        self.positions = {}       # problem id -> 在 problems 中的位置
+        self.by_title = {}        # 標題 -> 第一個使用此標題的 problem id
+        self.by_number = {}       # 原病歷編號 -> 第一個使用此編號的 problem id
+        self.histories = {}
+        self.bodies = {}          # problem id -> 已去除編號的 A 段落內容
+        self.commit_problem = {}  # commit id -> problem id
+        self.created_by = {}      # commit id -> 由該 commit 新增的 problem id
+        self.next_id = 0
+        for p in problems:
+            self._add(p['title'], p['full_content'])
+
+    def _add(self, title, content):
+        number = PROBLEM_NUMBER_RE.match(title)
+        problem = record(id=self.next_id, title=title, full_content=content, number=int(number.group(1)) if number else None)
+        self.next_id += 1
+        self.positions[problem['id']] = len(self.problems)
+        self.problems.append(problem)
+        self.by_id[problem['id']] = problem
+        self.by_title.setdefault(title, problem['id'])
+        if problem['number'] is not None:
+            self.by_number.setdefault(problem['number'], problem['id'])
+        self.histories[problem['id']] = ProblemHistory(content, self.snapshot_every)
+        self.bodies[problem['id']] = render_problem_body(content)
+        return problem
+
+    def _set_content(self, problem_id, content):
+        old = self.by_id[problem_id]
+        problem = self.by_id[problem_id] = record(id=problem_id, title=old['title'], full_content=content, number=old['number'])
+        self.problems[self.positions[problem_id]] = problem
+        self.bodies[problem_id] = render_problem_body(content)
+
+    def find(self, title):
+        problem_id = self.by_title.get(title)
+        return None if problem_id is None else self.by_id[problem_id]
+
+    def find_number(self, number):
+        problem_id = self.by_number.get(number)
+        return None if problem_id is None else self.by_id[problem_id]
+
+    def _reindex_after_remove(self, problem):
+        position = self.positions.pop(problem['id'])
+        del self.problems[position]
+        for p in self.problems[position:]:
+            self.positions[p['id']] -= 1
+        # 同標題 / 同編號的病名可能不只一個，被刪除的若是索引中的那一個，改指向下一個
+        if self.by_title.get(problem['title']) == problem['id']:
+            del self.by_title[problem['title']]
+            replacement = next((p['id'] for p in self.problems if p['title'] == problem['title']), None)
+            if replacement is not None: self.by_title[problem['title']] = replacement
+        if problem['number'] is not None and self.by_number.get(problem['number']) == problem['id']:
+            del self.by_number[problem['number']]
+            replacement = next((p['id'] for p in self.problems if p['number'] == problem['number']), None)
+            if replacement is not None: self.by_number[problem['number']] = replacement
+
+    def add_problem(self, commit_id, title, content):
+        problem = self._add(title, content)
+        self.created_by[commit_id] = problem['id']
+        return problem
+
+    def apply(self, commit_id, problem_id, content):
+        self.commit_problem[commit_id] = problem_id
+        merged = self.histories[problem_id].apply(commit_id, content)
+        self._set_content(problem_id, merged)
+        return merged
+
+    def remove(self, commit_id):
+        if commit_id in self.created_by:
+            problem_id = self.created_by.pop(commit_id)
+            self._reindex_after_remove(self.by_id.pop(problem_id))
+            del self.histories[problem_id], self.bodies[problem_id]
+            for cid in [c for c, pid in self.commit_problem.items() if pid == problem_id]:
+                del self.commit_problem[cid]
+            return problem_id
+        problem_id = self.commit_problem.pop(commit_id, None)
+        if problem_id is not None:
+            self._set_content(problem_id, self.histories[problem_id].remove(commit_id))
+        return problem_id
+
+    def final_text(self):
+        return "\n\n".join(f"{idx+1}. {self.bodies[p['id']]}" for idx, p in enumerate(self.problems))
+
+# =========================
+#  解析快取：以內容 hash 為 key，同一個 server process 內跨 session 共用
+# =========================
+class ContentCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8") if isinstance(part, str) else part
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = compute()
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "max_entries": self.max_entries}
+
+def dedup_log_sources(dedup, sources, since=None):
+    # 單一來源維持串流；多來源需在主 process 先去重 (跨檔比對)，再把剩下的行交給 worker 解析
+    if len(sources) == 1:
+        return [dedup.filter(iter_source_lines(sources[0], since))]
+    return [list(dedup.filter(iter_source_lines(source, since))) for source in sources]
+
+def ingest_log_sources(aggregator, sources, max_workers=None, since=None):
+    dedup = aggregator.dedup
+    if active_profiler() is None:
+        return aggregator.add(parse_log_sources(dedup_log_sources(dedup, sources, since), max_workers))
+    # 量測模式：各 stage 在本 process 依序完整跑完，才能分別記錄耗時與記憶體
+    with profile_stage("upload_decode", sources=len(sources)) as record:
+        texts = [source if isinstance(source, str) else source.decode("utf-8") if isinstance(source, (bytes, bytearray))
+                 else "\n".join(source) for source in sources]
+        record["chars"] = sum(map(len, texts))
+    with profile_stage("dedup") as record:
+        skipped_before = dedup.skipped_lines
+        unique_lines = [list(dedup.filter(iter_source_lines(text, since))) for text in texts]
+        record["skipped_lines"] = dedup.skipped_lines - skipped_before
+    with profile_stage("log_parse") as record:
+        tables = [parse_logs_from_lines(lines) for lines in unique_lines]
+        record["entries"] = sum(map(len, tables))
+    with profile_stage("classification"):
+        for entries in tables:
+            classify_entries(entries)
+    with profile_stage("aggregation"):
+        if len(tables) == 1:
+            return aggregator.add(tables[0])
+        return aggregator.add(heapq.merge(*(sorted(entries, key=entry_time_key) for entries in tables), key=entry_time_key))
+
+def build_log_aggregator(sources, formulary_data=None, max_workers=None):
+    formulary = DrugFormulary.from_lines(formulary_data.decode("utf-8").splitlines()) if formulary_data else None
+    aggregator = MedicationAggregator(formulary)
+    ingest_log_sources(aggregator, sources, max_workers)
+    return aggregator
+
+def parse_soap_profiled(soap_text):
+    with profile_stage("soap_parse", chars=len(soap_text)):
+        return parse_historical_soap(soap_text)
+
+def parse_soap_cached(cache, soap_text):
+    return cache.get_or_compute(ContentCache.key("soap", soap_text), lambda: parse_soap_profiled(soap_text))
+
+def aggregate_logs_cached(cache, sources, formulary_data=None):
+    key = ContentCache.key("logs", formulary_data or b"", *sources)
+    # 快取中的 aggregator 供所有 session 共用，回傳複本以免追加 log 時互相影響
+    return cache.get_or_compute(key, lambda: build_log_aggregator(sources, formulary_data)).copy()
+
+# =========================
+#  病人資料庫 (SQLite)：上次存檔的 A/P、醫囑彙整狀態與列印時間 high-water mark
+# =========================
+PATIENT_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    a_text TEXT NOT NULL,
+    p_text TEXT NOT NULL,
+    high_water INTEGER NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    patient_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    timestamp TEXT,
+    raw_line TEXT NOT NULL,
+    entry_name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    notes TEXT NOT NULL,
+    feature TEXT,
+    pending INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, kind, name)
+);
+"""
+
+# 只保存每個醫囑最後一筆 entry (即 MedicationAggregator 的狀態)，載入成本與住院天數無關
+class PatientStore:
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(PATIENT_STORE_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def save(self, patient_id, a_text, p_text, aggregator, pending=((), ())):
+        pending_meds, pending_others = set(pending[0]), set(pending[1])
+        rows = [
+            (patient_id, 'med', key, ts, entry.timestamp, entry.raw_line, entry.name, entry.action,
+             json.dumps(entry.notes, ensure_ascii=False), entry.feature, key in pending_meds)
+            for key, (ts, entry) in aggregator.latest_meds.items()
+        ] + [
+            (patient_id, 'other', key, ts, entry.timestamp, entry.raw_line, entry.name,
+             entry.action, json.dumps(entry.notes, ensure_ascii=False), entry.feature, key in pending_others)
+            for key, (ts, entry) in aggregator.latest_others.items()
+        ]
+        updated_at = time.strftime("%Y/%m/%d %H:%M")
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM orders WHERE patient_id = ?", (patient_id,))
+            self.conn.executemany("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?)",
+                (patient_id, a_text, p_text, aggregator.high_water(), updated_at),
+            )
+
+    def load(self, patient_id, formulary=None):
+        with self.lock:
+            patient = self.conn.execute(
+                "SELECT a_text, p_text, high_water, updated_at FROM patients WHERE patient_id = ?", (patient_id,)
+            ).fetchone()
+            if patient is None:
+                return None
+            rows = self.conn.execute(
+                "SELECT kind, timestamp, raw_line, entry_name, action, notes, feature, pending FROM orders "
+                "WHERE patient_id = ? ORDER BY ts, rowid", (patient_id,)
+            ).fetchall()
+        # 以目前的處方集重新彙整，藥名對照表更新後 key 也會跟著更新
+        aggregator = MedicationAggregator(formulary)
+        pending_meds, pending_others = set(), set()
+        for kind, timestamp, raw_line, entry_name, action, notes, feature, pending in rows:
+            entry = LogEntry(timestamp, raw_line)
+            entry.name = entry.details = entry_name
+            entry.action = action
+            entry.notes = tuple(json.loads(notes))
+            entry.is_med = kind == 'med'
+            entry.feature = feature
+            changed_meds, changed_others = aggregator.add((entry,))
+            if pending:
+                pending_meds |= changed_meds
+                pending_others |= changed_others
+        a_text, p_text, high_water, updated_at = patient
+        return {
+            "a_text": a_text, "p_text": p_text, "high_water": high_water, "updated_at": updated_at,
+            "aggregator": aggregator, "pending": (pending_meds, pending_others),
+        }
+
+    def info(self, patient_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT high_water, updated_at FROM patients WHERE patient_id = ?", (patient_id,)
+            ).fetchone()
+        return None if row is None else {"high_water": row[0], "updated_at": row[1]}
+
+    def patient_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT patient_id FROM patients ORDER BY patient_id")]
+
+# =========================
+#  A/P 組裝 (UI 與批次模式共用)
+# =========================
+def format_staged_updates(staged):
+    new_update_lines = []
+    for cat in SECTION_HEADERS:
+        items = staged[cat]
+        if items:
+            new_update_lines.append(cat)
+            for item in items:
+                disp = item['data']['display']
+                if cat in ["[Current Management]", "[Past treatment]"]:
+                    if "[DC]" in disp: new_update_lines.append(f"- {disp} due to ____________")
+                    else: new_update_lines.append(f"- {disp} for ____________")
+                elif cat == "[Consult]": new_update_lines.append(f"- F/U {disp}")
+                else: new_update_lines.append(f"- {disp}")
+            new_update_lines.append("")
+    return "\n".join(new_update_lines).strip()
+
+PLAN_SECTION_RES = (
+    ("[Current Management]", re.compile(r'\[\s*Current Management\s*\](.*?)(?=\n\s*\[|\Z)', re.DOTALL | re.IGNORECASE)),
+    ("[Consult]", re.compile(r'\[\s*Consult\s*\](.*?)(?=\n\s*\[|\Z)', re.DOTALL | re.IGNORECASE)),
+)
+
+# 單一 commit 對 P 段的貢獻 (病名 + Current Management / Consult)；沒有內容時為空字串
+def plan_fragment(title, content):
+    clean_title = NUMBER_PREFIX_RE.sub('', title)
+    blocks = []
+    for header, section_re in PLAN_SECTION_RES:
+        match = section_re.search(content)
+        if match and match.group(1).strip():
+            blocks.append(header + "\n" + match.group(1).strip())
+    return f"{clean_title}\n" + "\n".join(blocks) if blocks else ""
+
+# 與 build_plan_text 結果相同：在已組好的 P 段後面接上一個 commit 的 fragment
+def append_plan_fragment(plan_text, fragment):
+    if not fragment:
+        return plan_text
+    return (plan_text + "\n\n" + fragment).strip() if plan_text else fragment.strip()
+
+def build_plan_text(hist_plan, commits):
+    plan_updates = []
+    for c in commits:
+        fragment = c.get('plan_fragment')
+        if fragment is None:
+            fragment = plan_fragment(c['title'], c['content'])
+        if fragment:
+            plan_updates.append(fragment)
+
+    combined_plan = hist_plan.strip() if hist_plan else ""
+    if plan_updates:
+        if combined_plan:
+            combined_plan += "\n\n"
+        combined_plan += "\n\n".join(plan_updates)
+    return combined_plan.strip()
+
+def render_final_ap(a_text, p_text):
+    return f"A:\n{a_text}\n\nP:\n{p_text}"
+
+# =========================
+#  單一病人的編輯狀態 (與 UI 無關；Streamlit 只負責顯示與轉呼叫)
+# =========================
+NEW_PROBLEM_BASE = "New Problem: \n"
+EMPTY_COMMIT_CONTENT = "(無新增內容)"
+
+class SoapSession:
+    def __init__(self):
+        self.commit_log = CommitLog([])
+        self.hist_plan = ""
+        self.log_aggregator = MedicationAggregator()
+        self.unassigned_meds = OrderPool(sort_key=med_sort_key)
+        self.unassigned_others = OrderPool(sort_key=other_sort_key)
+        self.staged = {sec: [] for sec in SECTION_HEADERS}
+        self.commits = []
+        self.commit_counter = 1
+        self.final_text = ""
+        self.cached_plan = None  # P 段組合結果；新增 commit 時直接接上，刪除時才重組
+
+    @property
+    def hist_probs(self):
+        return self.commit_log.problems
+
+    def load_soap(self, problems, hist_plan):
+        self.commit_log = CommitLog(problems)
+        self.hist_plan = hist_plan
+        self.cached_plan = None
+
+    def load_logs(self, aggregator):
+        self.log_aggregator = aggregator
+        final_meds, final_others = aggregator.results()
+        self.unassigned_meds = OrderPool(final_meds, med_sort_key)
+        self.unassigned_others = OrderPool(final_others, other_sort_key)
+
+    def order_pool(self, item_type):
+        return self.unassigned_meds if item_type == 'med' else self.unassigned_others
+
+    def has_unassigned(self):
+        return bool(self.unassigned_meds or self.unassigned_others)
+
+    def base_text(self, title):
+        if title is None:
+            return NEW_PROBLEM_BASE
+        problem = self.commit_log.find(title)
+        return problem['full_content'] if problem else ""
+
+    def stage_item(self, item_type, data_obj, category):
+        self.order_pool(item_type).discard(data_obj['name'])
+        self.staged[category].append(record(type=item_type, data=data_obj))
+
+    def unstage_item(self, category, staged_obj):
+        self.staged[category].remove(staged_obj)
+        self.order_pool(staged_obj['type']).add(staged_obj['data'])
+
+    def resume(self, stored, sources=()):
+        # 從病人資料庫接續：上次的 A/P 當作歷史 SOAP，上次未處理的醫囑放回未分配清單，
+        # 新上傳的 log 只解析 high-water mark 之後的列印區塊
+        self.load_soap(*parse_historical_soap(render_final_ap(stored['a_text'], stored['p_text'])))
+        aggregator = self.log_aggregator = stored['aggregator']
+        pending_meds, pending_others = stored['pending']
+        self.unassigned_meds = OrderPool((aggregator.med_item(name) for name in pending_meds), med_sort_key)
+        self.unassigned_others = OrderPool((aggregator.other_item(name) for name in pending_others), other_sort_key)
+        if sources:
+            self.ingest_more_logs(sources, since=stored['high_water'])
+
+    def pending_orders(self):
+        # 尚未 commit 的醫囑 (未分配 + 購物車中)，存檔後下次仍會出現
+        staged = [(item['type'], item['data']['name']) for items in self.staged.values() for item in items]
+        return (
+            set(self.unassigned_meds.by_name) | {name for item_type, name in staged if item_type == 'med'},
+            set(self.unassigned_others.by_name) | {name for item_type, name in staged if item_type == 'other'},
+        )
+
+    def save(self, store, patient_id, a_text, p_text):
+        store.save(patient_id, a_text, p_text, self.log_aggregator, self.pending_orders())
+
+    def ingest_more_logs(self, sources, since=None):
+        aggregator = self.log_aggregator
+        changed_meds, changed_others = ingest_log_sources(aggregator, sources, since=since)
+        staged_at = {(item['type'], item['data']['name']): (items, i) for items in self.staged.values() for i, item in enumerate(items)}
+        for item_type, changed, make_item in (('med', changed_meds, aggregator.med_item), ('other', changed_others, aggregator.other_item)):
+            for name in changed:
+                new_item = make_item(name)
+                staged = staged_at.get((item_type, name))
+                if staged is not None:
+                    items, i = staged
+                    items[i] = record(type=item_type, data=new_item)
+                else: self.order_pool(item_type).add(new_item)
+
+    def commit(self, target_title, current_edit):
+        # target_title 為 None 表示建立新病名
+        is_new = target_title is None
+        commit_id = self.commit_counter
+        commit_content = current_edit if current_edit.strip() else EMPTY_COMMIT_CONTENT
+
+        with profile_stage("merge", commit=commit_id):
+            if is_new:
+                final_problem_text = parse_and_merge_updates(NEW_PROBLEM_BASE, current_edit)
+                first_line = final_problem_text.strip().split('\n')[0]
+                actual_title = first_line if len(first_line) > 2 else f"New Problem {len(self.hist_probs)+1}"
+                self.commit_log.add_problem(commit_id, actual_title, final_problem_text)
+            else:
+                actual_title = target_title
+                target = self.commit_log.find(target_title)
+                final_problem_text = self.commit_log.apply(commit_id, target['id'], commit_content)
+
+        commit = {
+            "id": commit_id,
+            "title": actual_title,
+            "is_new": is_new,
+            "content": commit_content,
+            "full_text": final_problem_text,
+            "used_items": {cat: tuple(items) for cat, items in self.staged.items()},
+            "plan_fragment": plan_fragment(actual_title, commit_content),
+        }
+        self.commits.append(commit)
+        if self.cached_plan is not None:
+            self.cached_plan = append_plan_fragment(self.cached_plan, commit['plan_fragment'])
+        self.commit_counter += 1
+        for cat in self.staged: self.staged[cat].clear()
+        return commit
+
+    def delete_commit(self, commit_id):
+        commit_to_delete = next((c for c in self.commits if c['id'] == commit_id), None)
+        if not commit_to_delete: return
+
+        for cat, items in commit_to_delete['used_items'].items():
+            for item in items:
+                pool = self.order_pool(item['type'])
+                if item['data']['name'] not in pool:
+                    pool.add(item['data'])
+
+        self.commits = [c for c in self.commits if c['id'] != commit_id]
+        self.cached_plan = None
+        with profile_stage("commit_replay", commit=commit_id):
+            self.commit_log.remove(commit_id)
+        self.push()
+
+    def push(self):
+        with profile_stage("final_render", problems=len(self.hist_probs)):
+            self.final_text = self.commit_log.final_text()
+
+    def plan_text(self):
+        if self.cached_plan is None:
+            with profile_stage("plan_render", commits=len(self.commits)):
+                self.cached_plan = build_plan_text(self.hist_plan, self.commits)
+        return self.cached_plan
+
+    def memory_report(self):
+        # 依序計算，後面的項目只算前面沒算過的部分 (例如 commit 中與未分配清單共用的醫囑不重複計算)
+        seen = set()
+        report = {
+            "problems": deep_sizeof(self.commit_log, seen),
+            "log_state": deep_sizeof(self.log_aggregator, seen),
+            "order_pools": deep_sizeof((self.unassigned_meds, self.unassigned_others), seen),
+            "staged": deep_sizeof(self.staged, seen),
+            "commits": deep_sizeof(self.commits, seen),
+        }
+        report["total"] = sum(report.values())
+        return report
@@ -0,0 +1,338 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from soap_core import (
+    SoapSession, build_log_aggregator, parse_and_merge_updates, parse_historical_soap, parse_log_sources,
+    parse_problem, render_final_ap,
+)
+
+# =========================
+#  Endpoint 實作 (在 worker process 中執行；輸入輸出皆為 JSON 物件)
+# =========================
+def log_sources(body):
+    logs = body["logs"]
+    return [logs] if isinstance(logs, str) else list(logs)
+
+def formulary_data(body):
+    formulary = body.get("formulary")
+    return formulary.encode("utf-8") if formulary else None
+
+def handle_parse_soap(body):
+    problems, plan = parse_historical_soap(body["soap_text"])
+    return {
+        "problems": [
+            {"title": p["title"], "number": p["number"], "full_content": p["full_content"],
+             "sections": {sec: list(span) for sec, span in parse_problem(p["full_content"]).spans.items()}}
+            for p in problems
+        ],
+        "plan": plan,
+    }
+
+def handle_parse_logs(body):
+    entries = parse_log_sources(log_sources(body), max_workers=1)
+    return {"entries": [
+        {"timestamp": e.timestamp, "action": e.action, "name": e.name, "notes": list(e.notes),
+         "is_med": e.is_med, "feature": e.feature}
+        for e in entries
+    ]}
+
+def handle_process(body):
+    aggregator = build_log_aggregator(log_sources(body), formulary_data(body), max_workers=1)
+    meds, others = aggregator.results()
+    return {
+        "meds": [dict(m) for m in meds],
+        "others": [dict(o) for o in others],
+        "high_water": aggregator.high_water(),
+        "skipped_duplicate_lines": aggregator.dedup.skipped_lines,
+    }
+
+def handle_merge(body):
+    return {"text": parse_and_merge_updates(body["base_text"], body["updates"])}
+
+def handle_render(body):
+    # commits: [{"problem": 標題 / 病歷編號 / null (新病名), "content": 更新內容}]，依序套用後輸出 A/P
+    session = SoapSession()
+    session.load_soap(*parse_historical_soap(body.get("soap_text", "")))
+    for c in body.get("commits", []):
+        target = c.get("problem")
+        if target is None:
+            session.commit(None, c["content"])
+            continue
+        if isinstance(target, bool):
+            raise ValueError(f"problem must be a title, number or null, not {target!r}")
+        problem = session.commit_log.find_number(target) if isinstance(target, int) else session.commit_log.find(target)
+        if problem is None:
+            raise ValueError(f"unknown problem: {target!r}")
+        session.commit(problem["title"], c["content"])
+    session.push()
+    a_text, p_text = session.final_text, session.plan_text()
+    return {"a_text": a_text, "p_text": p_text, "text": render_final_ap(a_text, p_text)}
+
+ENDPOINTS = {
+    "/parse/soap": handle_parse_soap,
+    "/parse/logs": handle_parse_logs,
+    "/process": handle_process,
+    "/merge": handle_merge,
+    "/render": handle_render,
+}
+# 耗時與 log 大小成正比的 endpoint 不與其他請求併批，避免短請求被卡在後面
+HEAVY_ENDPOINTS = {"/parse/logs", "/process"}
+
+# 一個 batch 在 worker 內依序執行；單筆失敗不影響同 batch 的其他請求
+def run_batch(jobs):
+    results = []
+    for endpoint, body in jobs:
+        try:
+            results.append((200, ENDPOINTS[endpoint](body)))
+        except (KeyError, TypeError, ValueError, AttributeError, csv.Error) as exc:
+            results.append((400, {"error": f"{type(exc).__name__}: {exc}"}))
+        except Exception as exc:  # 單筆失敗不影響同一批的其他請求
+            results.append((500, {"error": f"{type(exc).__name__}: {exc}"}))
+    return results
+
+def warm_worker():
+    # 預先載入並跑過一次各 stage，讓 regex / lru_cache 在第一個真正的請求前就緒
+    run_batch([
+        ("/parse/soap", {"soap_text": "A:\n1. Warm up\n[Exam]\n- x\nP:\n- y"}),
+        ("/process", {"logs": "列印時間:2024/01/01 00:00\nNEW Warmup 1mg PO QD"}),
+        ("/merge", {"base_text": "1. Warm up\n[Exam]\n- x", "updates": "[Exam]\n- z"}),
+    ])
+
+def worker_pid():
+    time.sleep(0.05)  # 讓同時送出的 ping 分散到不同 worker，確保每個 worker 都被建立
+    return os.getpid()
+
+# =========================
+#  Request batching：worker 都在忙時，新請求先排隊，下一個空出的 worker 一次處理一整批
+#  (短請求最多 max_batch 筆一批；HEAVY_ENDPOINTS 每筆單獨送出)
+# =========================
+class Batcher:
+    def __init__(self, pool, workers, max_batch=16):
+        self.pool = pool
+        self.workers = workers
+        self.max_batch = max_batch
+        self.cond = threading.Condition()
+        self.pending = []   # [(endpoint, body, Future)]
+        self.inflight = 0
+        self.batches = 0
+        self.batched_requests = 0
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def submit(self, endpoint, body):
+        future = Future()
+        with self.cond:
+            self.pending.append((endpoint, body, future))
+            self.cond.notify()
+        return future
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending or (self.inflight >= self.workers and len(self.pending) < self.max_batch):
+                    self.cond.wait()
+                jobs = self._take_batch()
+                self.inflight += 1
+                self.batches += 1
+                self.batched_requests += len(jobs)
+            try:
+                batch_future = self.pool.submit(run_batch, [(endpoint, body) for endpoint, body, _ in jobs])
+            except RuntimeError as exc:  # pool 已關閉或 worker 崩潰 (BrokenProcessPool)
+                batch_future = Future()
+                batch_future.set_exception(exc)
+            batch_future.add_done_callback(lambda f, jobs=jobs: self._finish(f, jobs))
+
+    def _take_batch(self):
+        if self.pending[0][0] in HEAVY_ENDPOINTS:
+            return [self.pending.pop(0)]
+        jobs, rest = [], []
+        for job in self.pending:
+            if len(jobs) < self.max_batch and job[0] not in HEAVY_ENDPOINTS:
+                jobs.append(job)
+            else:
+                rest.append(job)
+        self.pending = rest
+        return jobs
+
+    def _finish(self, batch_future, jobs):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify()
+        try:
+            results = batch_future.result()
+        except Exception as exc:  # worker 異常結束等，整批回報錯誤
+            results = [(500, {"error": f"{type(exc).__name__}: {exc}"})] * len(jobs)
+        for (_, _, future), result in zip(jobs, results):
+            future.set_result(result)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": len(self.pending), "inflight_batches": self.inflight, "batches": self.batches,
+                "mean_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+            }
+
+class SoapService:
+    def __init__(self, workers=None, max_inflight=64, queue_timeout=5.0, request_timeout=60.0,
+                 max_body=16 << 20, max_batch=16):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+        self.worker_pids = sorted(set(f.result() for f in [self.pool.submit(worker_pid) for _ in range(self.workers)]))
+        self.batcher = Batcher(self.pool, self.workers, max_batch)
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.max_inflight = max_inflight
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.max_body = max_body
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "rejected": 0, "errors": 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def call(self, jobs):
+        # 併發上限：超過 max_inflight 的請求最多等 queue_timeout 秒，否則回 503
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            self.count("rejected")
+            return 503, {"error": "server busy, retry later"}
+        try:
+            self.count("requests", len(jobs))
+            futures = [self.batcher.submit(endpoint, body) for endpoint, body in jobs]
+            deadline = time.monotonic() + self.request_timeout
+            results = [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+        except FutureTimeoutError:
+            self.count("errors")
+            return 504, {"error": "request timed out"}
+        finally:
+            self.slots.release()
+        self.count("errors", sum(status != 200 for status, _ in results))
+        return results
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {**counts, **self.batcher.stats(), "workers": len(self.worker_pids), "max_inflight": self.max_inflight}
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+# =========================
+#  HTTP 介面
+# =========================
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "workers": len(service.worker_pids)})
+        elif self.path == "/stats":
+            self.send_json(200, service.stats())
+        else:
+            self.send_json(404, {"error": f"unknown endpoint: {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        # 讀 body 前先檢查長度：缺少時無法判斷 body 結束 (411)，非整數或負數會讓 read 出錯或卡住 (400)
+        raw_length = self.headers.get("Content-Length")
+        if raw_length is None:
+            self.close_connection = True
+            self.send_json(411, {"error": "Content-Length header is required"})
+            return
+        raw_length = raw_length.strip()
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            self.close_connection = True
+            self.send_json(400, {"error": f"invalid Content-Length: {raw_length!r}"})
+            return
+        length = int(raw_length)
+        if length > service.max_body:
+            self.close_connection = True
+            self.send_json(413, {"error": f"request body larger than {service.max_body} bytes"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as exc:
+            self.send_json(400, {"error": f"invalid JSON: {exc}"})
+            return
+
+        # /batch：{"requests": [{"endpoint": "/merge", "body": {...}}, ...]}，結果依序回傳
+        if self.path == "/batch":
+            requests = body.get("requests") if isinstance(body, dict) else None
+            if not isinstance(requests, list) or any(
+                    not isinstance(r, dict) or r.get("endpoint") not in ENDPOINTS for r in requests):
+                self.send_json(400, {"error": f"batch requests need an endpoint in {sorted(ENDPOINTS)}"})
+                return
+            result = service.call([(r["endpoint"], r.get("body", {})) for r in requests])
+            if isinstance(result, tuple):
+                self.send_json(*result)
+            else:
+                self.send_json(200, {"results": [{"status": status, "body": payload} for status, payload in result]})
+        elif self.path in ENDPOINTS:
+            if not isinstance(body, dict):
+                self.send_json(400, {"error": "request body must be a JSON object"})
+                return
+            result = service.call([(self.path, body)])
+            self.send_json(*(result if isinstance(result, tuple) else result[0]))
+        else:
+            self.send_json(404, {"error": f"unknown endpoint: {self.path}"})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class ServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, ServiceHandler)
+        self.service = service
+        self.verbose = verbose
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the SOAP parse/process/merge/render pipeline over local HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="bind address (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None, help="warm worker processes (default: CPU count)")
+    parser.add_argument("--max-inflight", type=int, default=64, help="requests processed concurrently; others wait")
+    parser.add_argument("--queue-timeout", type=float, default=5.0, help="seconds to wait for a slot before 503")
+    parser.add_argument("--request-timeout", type=float, default=60.0, help="seconds before a request returns 504")
+    parser.add_argument("--max-batch", type=int, default=16, help="most requests sent to one worker at a time")
+    parser.add_argument("--max-body-mb", type=float, default=16, help="largest accepted request body")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    service = SoapService(args.workers, args.max_inflight, args.queue_timeout, args.request_timeout,
+                          int(args.max_body_mb * (1 << 20)), args.max_batch)
+    server = ServiceServer((args.host, args.port), service, args.verbose)
+    print(f"{len(service.worker_pids)} workers warmed in {time.perf_counter() - start:.2f}s; "
+          f"serving on http://{args.host}:{args.port} ({', '.join(sorted(ENDPOINTS))}, /batch)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
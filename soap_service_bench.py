@@ -0,0 +1,92 @@
+import sys
+import json
+import time
+import random
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from soap_synth import generate_log_lines, generate_soap, generate_update
+
+# =========================
+#  HTTP service 壓力測試：固定併發數送出混合請求，回報 throughput 與延遲分位數
+# =========================
+def build_payloads(seed, log_lines, problems):
+    rng = random.Random(seed)
+    soap_text = generate_soap(problems, seed)
+    logs = "\n".join(generate_log_lines(log_lines, seed))
+    base = soap_text.split("A:", 1)[-1].split("\n\n")[0].strip() or "1. Problem"
+    return {
+        "/merge": lambda: {"base_text": base, "updates": generate_update(rng.randrange(1 << 30))},
+        "/parse/soap": lambda: {"soap_text": soap_text},
+        "/process": lambda: {"logs": logs},
+        "/render": lambda: {"soap_text": soap_text, "commits": [
+            {"problem": rng.randint(1, problems), "content": generate_update(rng.randrange(1 << 30))} for _ in range(3)
+        ]},
+    }
+
+def post(url, body, timeout):
+    data = json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as exc:
+        exc.read()
+        status = exc.code
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        status = 0
+    return status, time.perf_counter() - start
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test a running soap_service.py instance.")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--requests", type=int, default=2000, help="total requests to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--mix", default="/merge=6,/render=2,/parse/soap=1,/process=1",
+                        help="endpoint weights, e.g. /merge=6,/process=1")
+    parser.add_argument("--log-lines", type=int, default=2000, help="log size used for /process requests")
+    parser.add_argument("--problems", type=int, default=10, help="problems in the generated SOAP")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    payloads = build_payloads(args.seed, args.log_lines, args.problems)
+    weights = {}
+    for part in args.mix.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint not in payloads:
+            parser.error(f"unknown endpoint in --mix: {endpoint} (choose from {', '.join(payloads)})")
+        weights[endpoint] = float(weight or 1)
+    rng = random.Random(args.seed)
+    plan = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    bodies = [(endpoint, payloads[endpoint]()) for endpoint in plan]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda job: (job[0], *post(args.url + job[0], job[1], args.timeout)), bodies))
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(results)} requests in {elapsed:.2f}s ({len(results) / elapsed:.1f} req/s, concurrency {args.concurrency})")
+    print(f"{'endpoint':<14}{'n':>7}{'ok':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint in ["(all)"] + sorted(weights):
+        rows = [r for r in results if endpoint == "(all)" or r[0] == endpoint]
+        latencies = sorted(latency * 1000 for _, _, latency in rows)
+        ok = sum(status == 200 for _, status, _ in rows)
+        print(f"{endpoint:<14}{len(rows):>7}{ok:>7}{percentile(latencies, 50):>10.1f}{percentile(latencies, 95):>10.1f}"
+              f"{percentile(latencies, 99):>10.1f}{(latencies[-1] if latencies else float('nan')):>10.1f}")
+    failed = sum(status != 200 for _, status, _ in results)
+    if failed:
+        print(f"{failed} requests failed (0 = connection error, 503 = over the concurrency limit)", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import random
+import argparse
+
+# =========================
+#  合成資料產生器：模擬 HIS 醫囑列印 log 與多病名 SOAP (benchmark / 壓力測試用)
+# =========================
+DRUGS = [
+    ("Vancomycin", "1g", "IV", "Q12H"), ("Meropenem", "500mg", "IV", "Q8H"), ("Pantoprazole", "40mg", "IV", "QD"),
+    ("Acetaminophen", "500mg", "PO", "Q6H PRN"), ("Furosemide", "20mg", "IV", "BID"), ("Insulin RI", "10iu", "SC", "TID"),
+    ("KCl", "20mEq", "PO", "ONCE"), ("Heparin", "5000iu", "SC", "Q12H"), ("Normal Saline", "500mL", "IVF", "QD"),
+    ("Morphine(管1)", "2mg", "IV", "Q4H PRN"), ("Nystatin susp", "1 vial", "TOPI", "QID"), ("Cefazolin", "1 vial", "IV", "Q8H"),
+    ("Famotidine", "20 mg", "PO", "BID"), ("Norepinephrine", "4mg", "IV", "Q1H"), ("Piperacillin/Tazobactam", "4.5g", "IV", "Q6H"),
+]
+LABS = ["CBC/DC", "Biochemistry", "Urine routine", "Blood culture", "Lactate", "Procalcitonin", "PT/aPTT"]
+SPECIMENS = ["B", "U", "S", "BV"]
+OTHERS = ["EKG 12 leads", "Chest X-ray portable", "Consult Nephrology", "Consult Infection", "CT Brain *:EMR",
+          "BLOOD GAS BV", "Bed rest", "NPO", "Foley care", "Turn over Q2H"]
+ACTIONS = ["NEW", "NEW", "NEW", "DC", "DC-D", "DC-C", "DC-E", "CHG", "EXTN"]
+CONTINUATIONS = ["continuous infusion", "over 30 min", "dilute in NS 100mL", "titrate to MAP>65", "keep K 4-5"]
+NOTES = ["(hold if SBP<90)", "(check trough before 4th dose)", "..sliding scale", "..per protocol"]
+PROBLEMS = ["Septic shock", "Acute kidney injury", "Acute respiratory failure", "Hypokalemia", "Upper GI bleeding",
+            "Type 2 diabetes mellitus", "Pneumonia", "Delirium", "Anemia", "Atrial fibrillation"]
+
+def generate_log_lines(n_lines, seed=0, start_day=1):
+    rng = random.Random(seed)
+    lines = []
+    day, minute = start_day, 0
+    while len(lines) < n_lines:
+        minute += rng.randint(30, 240)
+        day, minute = day + minute // 1440, minute % 1440
+        lines.append(f"列印時間:2024/01/{(day - 1) % 28 + 1:02d} {minute // 60:02d}:{minute % 60:02d}  醫師:王小明  床號:MICU-{rng.randint(1, 20):02d}")
+        lines.append("類別    醫囑內容                                  執行")
+        for _ in range(rng.randint(5, 40)):
+            kind = rng.random()
+            if kind < 0.55:
+                drug, dose, route, freq = rng.choice(DRUGS)
+                lines.append(f"{rng.choice(ACTIONS)} {drug} {dose} {route} {freq}   {rng.randint(1, 9)}天")
+                if rng.random() < 0.3:
+                    lines.append("      " + rng.choice(CONTINUATIONS))
+                if rng.random() < 0.2:
+                    lines.append(rng.choice(NOTES))
+            elif kind < 0.8:
+                lab = rng.choice(LABS)
+                specimen = rng.choice(SPECIMENS)
+                lines.append(f"{lab}  {specimen} *:EMR" if rng.random() < 0.5 else f"{rng.choice(['NEW', 'DC'])} {lab}  {specimen}")
+            else:
+                lines.append(rng.choice(OTHERS))
+            if rng.random() < 0.05:
+                lines.append("")
+    return lines[:n_lines]
+
+def generate_problem(rng, number, items_per_section=3):
+    title = f"{number}. {rng.choice(PROBLEMS)}"
+    parts = [title]
+    for sec in ["[Exam]", "[Past treatment]", "[Current Management]", "[Consult]"]:
+        if rng.random() < 0.8:
+            parts.append(sec)
+            for _ in range(rng.randint(1, items_per_section)):
+                drug = rng.choice(DRUGS)[0]
+                parts.append(f"- {drug} for {rng.choice(PROBLEMS).lower()}")
+    return "\n".join(parts)
+
+def generate_soap(n_problems, seed=0):
+    rng = random.Random(seed)
+    problems = [generate_problem(rng, i + 1) for i in range(n_problems)]
+    plan = "\n".join(f"- {rng.choice(PROBLEMS)}: keep current management" for _ in range(max(1, n_problems // 2)))
+    return "S: no acute distress overnight\nO: BT 37.2 HR 88 BP 118/70\nA:\n" + "\n\n".join(problems) + f"\nP:\n{plan}\n"
+
+def generate_update(seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for sec in rng.sample(["[Exam]", "[Past treatment]", "[Current Management]", "[Consult]"], rng.randint(1, 3)):
+        lines.append(sec)
+        drug = rng.choice(DRUGS)[0]
+        lines.append(f"- [Add] {drug} for ____________" if sec != "[Consult]" else f"- F/U {drug}")
+        lines.append("")
+    return "\n".join(lines).strip()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic HIS order logs and SOAP notes, one folder per patient.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--patients", type=int, default=1)
+    parser.add_argument("--lines", type=int, default=1000, help="log lines per patient")
+    parser.add_argument("--logs", type=int, default=1, help="log files per patient")
+    parser.add_argument("--problems", type=int, default=5, help="problems per SOAP note")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for p in range(args.patients):
+        patient_dir = os.path.join(args.output_dir, f"patient_{p + 1:03d}")
+        os.makedirs(patient_dir, exist_ok=True)
+        with open(os.path.join(patient_dir, "soap_input.txt"), 'w', encoding="utf-8") as f:
+            f.write(generate_soap(args.problems, seed=args.seed + p))
+        for k in range(args.logs):
+            with open(os.path.join(patient_dir, f"log_input_{k + 1}.txt"), 'w', encoding="utf-8") as f:
+                f.write("\n".join(generate_log_lines(args.lines, seed=(args.seed + p) * 1000 + k, start_day=1 + k)) + "\n")
+
+if __name__ == "__main__":
+    main()
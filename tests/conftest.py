@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 測試直接匯入根目錄的 soap_core / soap_synth (專案沒有打包設定)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
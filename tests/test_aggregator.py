@@ -0,0 +1,18 @@
+import soap_core as c
+
+def log(day, *orders):
+    return "\n".join([f"列印時間:2024/01/{day} 08:00  醫師:王小明  床號:MICU-01", *orders])
+
+def test_older_log_does_not_replace_newer_entries():
+    aggregator = c.build_log_aggregator([log("05", "Chest X-ray portable  AP view", "NEW Furosemide 20mg IV QD   3天")])
+    before = aggregator.results()
+    changed = c.ingest_log_sources(aggregator, [log("01", "Chest X-ray portable", "DC Furosemide 20mg IV QD   3天")])
+    assert changed == (set(), set())
+    assert aggregator.results() == before
+    assert aggregator.high_water() == 202401050800
+
+def test_same_time_later_entry_wins():
+    aggregator = c.build_log_aggregator([log("05", "Chest X-ray portable  AP view")])
+    changed = c.ingest_log_sources(aggregator, [log("05", "Chest X-ray portable  PA view")])
+    assert changed == (set(), {"Chest X-Ray Portable"})
+    assert aggregator.results()[1][0]['details'] == "Chest X-ray portable  PA view"
@@ -0,0 +1,101 @@
+import random
+import re
+
+import pytest
+
+import soap_core as c
+from soap_synth import generate_soap, generate_update
+
+# 原本的刪除 commit：從原始病名重新套用所有剩下的 commit，以病名找要合併的 problem
+def replay_final_text(original, commits):
+    problems = [{'title': p['title'], 'full_content': p['full_content']} for p in original]
+    for commit in commits:
+        if commit['is_new']:
+            problems.append({'title': commit['title'], 'full_content': commit['full_text']})
+            continue
+        for p in problems:
+            if p['title'] == commit['title']:
+                p['full_content'] = c.parse_and_merge_updates(p['full_content'], commit['content'])
+                break
+    bodies = [re.sub(r'^\d+\.\s*', '', p['full_content'].strip()) for p in problems]
+    return "\n\n".join(f"{idx+1}. {body}" for idx, body in enumerate(bodies))
+
+# 原本每次 rerun 重組的 P 段
+def rebuilt_plan(hist_plan, commits):
+    plan_updates = []
+    for commit in commits:
+        clean_title = re.sub(r'^\d+\.\s*', '', commit['title'])
+        blocks = []
+        for header in ("Current Management", "Consult"):
+            match = re.search(r'\[\s*' + header + r'\s*\](.*?)(?=\n\s*\[|\Z)', commit['content'], re.DOTALL | re.IGNORECASE)
+            if match and match.group(1).strip():
+                blocks.append(f"[{header}]\n" + match.group(1).strip())
+        if blocks:
+            plan_updates.append(f"{clean_title}\n" + "\n".join(blocks))
+    combined_plan = hist_plan.strip() if hist_plan else ""
+    if plan_updates:
+        if combined_plan:
+            combined_plan += "\n\n"
+        combined_plan += "\n\n".join(plan_updates)
+    return combined_plan.strip()
+
+EDIT_LINES = [
+    "[Current Management]", "[ current management ]", "[Consult]", "[CONSULT]", "[Exam]", "[Past treatment]",
+    "- [Add] Vancomycin for ____________", "- F/U ID", "  - keep", "", "  ", "[ x", "z ]",
+]
+
+def random_edit(rng):
+    roll = rng.random()
+    if roll < 0.1:
+        return rng.choice(["", "  \n"])
+    if roll < 0.6:
+        return generate_update(rng.randrange(10000))
+    return "\n".join(rng.choice(EDIT_LINES) for _ in range(rng.randint(1, 8)))
+
+def new_session(soap_text, snapshot_every):
+    problems, hist_plan = c.parse_historical_soap(soap_text)
+    sess = c.SoapSession()
+    sess.load_soap(problems, hist_plan)
+    sess.commit_log = c.CommitLog(problems, snapshot_every=snapshot_every)
+    return sess, problems, hist_plan
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_commit_and_undo_match_replay(seed):
+    rng = random.Random(seed)
+    for round_ in range(40):
+        sess, problems, hist_plan = new_session(generate_soap(rng.randint(1, 6), seed * 100 + round_), rng.choice((1, 2, 3, 8)))
+        # 新病名的標題都是 "New Problem:"，只對原有 (標題唯一) 的病名追加內容
+        titles = [p['title'] for p in problems]
+        for _ in range(rng.randint(1, 30)):
+            if sess.commits and rng.random() < 0.3:
+                sess.delete_commit(rng.choice(sess.commits)['id'])
+            else:
+                target = rng.choice(titles) if titles and rng.random() < 0.8 else None
+                sess.commit(target, random_edit(rng))
+                sess.push()
+            assert sess.final_text == replay_final_text(problems, sess.commits)
+            if rng.random() < 0.7:
+                # plan_text 之後的 commit 走 append_plan_fragment 的增量路徑
+                assert sess.plan_text() == rebuilt_plan(hist_plan, sess.commits)
+                assert sess.plan_text() == c.build_plan_text(hist_plan, sess.commits)
+
+def test_incremental_plan_matches_rebuilt_plan():
+    rng = random.Random(7)
+    for hist_plan in ("", "  \n", "- keep current management\n"):
+        sess, _, _ = new_session(f"A:\n1. Sepsis\n[Exam]\n- fever\nP:\n{hist_plan}", 8)
+        sess.plan_text()
+        for _ in range(50):
+            sess.commit(rng.choice(("1. Sepsis", None)), random_edit(rng))
+            assert sess.cached_plan == rebuilt_plan(hist_plan, sess.commits)
+
+def test_duplicate_new_titles_keep_their_commit_binding():
+    # 兩個新病名同為 "New Problem:"；原本的 replay 以標題找 problem，刪掉第一個後
+    # 追加的內容會跑到第二個身上。現在 commit 綁定在當時的 problem，隨它一起消失。
+    sess, problems, _ = new_session("A:\n1. Sepsis\nP:\n", 8)
+    first = sess.commit(None, "[Exam]\n- fever")
+    second = sess.commit(None, "[Exam]\n- cough")
+    assert first['title'] == second['title'] == "New Problem:"
+    sess.commit("New Problem:", "[Consult]\n- F/U ID")
+    sess.delete_commit(first['id'])
+    assert sess.final_text == "1. Sepsis\n\n2. " + second['full_text'].strip()
+    assert "F/U ID" in replay_final_text(problems, sess.commits)
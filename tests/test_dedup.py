@@ -0,0 +1,84 @@
+import random
+
+import soap_core as c
+from soap_synth import generate_log_lines
+
+HEADER = "類別    醫囑內容                                  執行"
+
+def print_block(time, *orders):
+    return [f"列印時間:2024/01/01 {time}  醫師:王小明  床號:MICU-01", HEADER, *orders]
+
+def statuses(sources):
+    meds, _ = c.build_log_aggregator(sources, max_workers=1).results()
+    return {m['name']: m['status'] for m in meds}
+
+def without_dedup(sources):
+    aggregator = c.MedicationAggregator()
+    aggregator.add(c.parse_log_sources(sources, max_workers=1))
+    return aggregator.results()
+
+def test_partial_reprint_across_uploads_keeps_print_time():
+    first = print_block("06:00", "NEW Furosemide 20mg IV QD   3天") + print_block("08:00", "NEW Vancomycin 1g IV Q12H   3天")
+    second = print_block("08:00", "NEW Vancomycin 1g IV Q12H   3天", "DC Furosemide 20mg IV QD   3天")
+    result = statuses(["\n".join(first), "\n".join(second)])
+    assert result == {'Furosemide Iv Qd': "Discontinued", 'Vancomycin Iv Q12H': "Active"}
+
+    dedup = c.LogDeduplicator()
+    list(dedup.filter(first))
+    # 標頭保留，欄位標題與已收過的 Vancomycin 略過
+    assert list(dedup.filter(second)) == print_block("08:00")[:1] + ["DC Furosemide 20mg IV QD   3天"]
+
+def test_reordered_reprint_keeps_later_orders():
+    # 同一分鐘內 DC 後再 NEW：第二個 NEW 先前收過，但略過它會讓最終狀態變成 DC
+    first = print_block("08:00", "NEW Furosemide 20mg IV QD   3天")
+    second = print_block("08:00", "DC Furosemide 20mg IV QD   3天", "NEW Furosemide 20mg IV QD   3天")
+    sources = ["\n".join(first), "\n".join(second)]
+    assert statuses(sources) == {'Furosemide Iv Qd': "Active"}
+    assert c.build_log_aggregator(sources, max_workers=1).results() == without_dedup(sources)
+
+    third = print_block("08:00", "NEW Furosemide 20mg IV QD   3天", "DC Furosemide 20mg IV QD   3天")
+    sources = ["\n".join(second), "\n".join(third)]
+    assert statuses(sources) == {'Furosemide Iv Qd': "Discontinued"}
+
+def test_same_minute_blocks_match_undeduplicated_results():
+    orders = [
+        "NEW Furosemide 20mg IV QD   3天", "DC Furosemide 20mg IV QD   3天", "NEW Vancomycin 1g IV Q12H   3天",
+        "DC Vancomycin 1g IV Q12H   3天", "CHG Vancomycin 1g IV Q12H   5天", "Chest X-ray portable", "NPO",
+    ]
+    rng = random.Random(0)
+    for _ in range(3000):
+        blocks = [print_block(rng.choice(("08:00", "08:01")), *rng.choices(orders, k=rng.randint(0, 5)))
+                  for _ in range(rng.randint(1, 6))]
+        cuts = sorted(rng.sample(range(1, len(blocks) + 1), rng.randint(1, min(3, len(blocks)))))
+        sources = ["\n".join(line for block in blocks[a:b] for line in block) for a, b in zip([0] + cuts, cuts)]
+        assert c.build_log_aggregator(sources, max_workers=1).results() == without_dedup(sources), blocks
+
+def test_same_block_twice_is_skipped():
+    lines = generate_log_lines(3000, 1)
+    dedup = c.LogDeduplicator()
+    assert list(dedup.filter(lines)) == lines
+    assert list(dedup.filter(lines)) == []
+    assert dedup.skipped_lines == len(lines)
+
+def test_duplicate_orders_within_one_block_are_kept():
+    block = print_block("09:00", "NEW KCl 20mEq PO ONCE   1天", "      over 30 min", "NEW KCl 20mEq PO ONCE   1天", "      over 30 min")
+    assert list(c.LogDeduplicator().filter(block)) == block
+
+def test_overlapping_uploads_match_undeduplicated_results():
+    lines = generate_log_lines(6000, 2)
+    text = "\n".join(lines)
+    for cut in (len(lines) // 3, len(lines) // 2 + 7, len(lines) - 5):
+        head, tail = "\n".join(lines[:cut]), "\n".join(lines[cut // 2:])
+        for sources in ([head, text], [head, tail], [text, head, tail]):
+            assert c.build_log_aggregator(sources, max_workers=1).results() == without_dedup(sources)
+
+def test_copy_is_independent():
+    first = print_block("06:00", "NEW Furosemide 20mg IV QD   3天")
+    second = print_block("06:00", "NEW Furosemide 20mg IV QD   3天", "NEW Vancomycin 1g IV Q12H   3天")
+    dedup = c.LogDeduplicator()
+    list(dedup.filter(first))
+    clone = dedup.copy()
+    expected = print_block("06:00")[:1] + ["NEW Vancomycin 1g IV Q12H   3天"]
+    assert list(clone.filter(second)) == expected
+    assert list(dedup.filter(second)) == expected
+    assert clone.skipped_lines == dedup.skipped_lines == 2
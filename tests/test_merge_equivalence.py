@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+import soap_core
+from soap_core import ParsedProblem, merge_sections_sequential, split_update_sections
+from soap_synth import generate_problem, generate_update
+
+# ParsedProblem 的單次重組必須與逐段 re.search 的 merge_sections_sequential 結果完全相同
+def sequential_merge(base_text, edited_updates):
+    if not edited_updates.strip():
+        return base_text
+    return merge_sections_sequential(base_text, split_update_sections(edited_updates))
+
+BASE_TOKENS = [
+    "[Exam]", "[ exam ]", "[Past treatment]", "[Consult]", "[CONSULT]", "[Current Management]", "[Plan]",
+    "[", "]", "\n", "\n\n", " ", "  ", "\t", "x", "foo", "- [DC] a", "Exam", "consult", "1. Sepsis", "[\n", "\r",
+    "Past treatment",
+]
+UPDATE_LINES = [
+    "- a", "  b  ", "[Exam]", "[Consult]", "[Past treatment]", "[Current Management]", "- [Add] X for ___", "", "  ",
+    "[ x", "c ]", "exam]", "Consult", "  [DC] y", "z\t", " [", "[ exam",
+]
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_fragments_match_sequential_merge(seed):
+    rng = random.Random(seed)
+    for _ in range(20000):
+        base = "".join(rng.choice(BASE_TOKENS) for _ in range(rng.randint(0, 14)))
+        updates = "\n".join(rng.choice(UPDATE_LINES) for _ in range(rng.randint(0, 10)))
+        assert ParsedProblem(base).merge(updates) == sequential_merge(base, updates), (base, updates)
+
+def test_synthetic_problems_use_fast_path(monkeypatch):
+    rng = random.Random(0)
+    cases = [(generate_problem(rng, i + 1), generate_update(i)) for i in range(2000)]
+    expected = [sequential_merge(base, updates) for base, updates in cases]
+
+    fallbacks = []
+    monkeypatch.setattr(soap_core, "merge_sections_sequential", lambda *args: fallbacks.append(args))
+    assert [ParsedProblem(base).merge(updates) for base, updates in cases] == expected
+    assert not fallbacks
+
+def test_repeated_merges_on_one_parsed_problem():
+    rng = random.Random(1)
+    base = generate_problem(rng, 1)
+    parsed = ParsedProblem(base)
+    for seed in range(200):
+        updates = generate_update(seed)
+        assert parsed.merge(updates) == sequential_merge(base, updates)
+    assert parsed.text == base
@@ -0,0 +1,35 @@
+import threading
+import tracemalloc
+
+from soap_core import StageProfiler
+
+def test_concurrent_stages_share_process_tracing():
+    profilers = [StageProfiler() for _ in range(8)]
+    barrier = threading.Barrier(len(profilers))
+
+    def run(profiler):
+        barrier.wait()
+        for i in range(50):
+            with profiler.stage("work", i=i):
+                data = [bytes(1000) for _ in range(50 + i % 7 * 20)]
+                del data
+
+    threads = [threading.Thread(target=run, args=(p,)) for p in profilers]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    records = [r for p in profilers for r in p.records]
+    assert len(records) == 8 * 50
+    assert all(r["peak_kb"] >= 0 for r in records)
+    assert not tracemalloc.is_tracing()
+
+def test_nested_stage_keeps_outer_peak():
+    profiler = StageProfiler()
+    with profiler.stage("outer"):
+        data = bytes(2 << 20)
+        del data
+        with profiler.stage("inner"):
+            pass
+    inner, outer = profiler.records
+    assert outer["peak_kb"] >= 2048
+    assert not tracemalloc.is_tracing()
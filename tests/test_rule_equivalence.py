@@ -0,0 +1,76 @@
+import random
+import re
+
+import pytest
+
+import soap_core as c
+from soap_synth import generate_log_lines, generate_soap
+
+# 原本逐一 re.search 的藥物判定規則
+MED_FEATURES = [r'\bQ\d+[HM]\b', r'\bQD\b', r'\bBID\b', r'\bTID\b', r'\bQID\b',
+    r'\bONCE\b', r'\bPRN\b', r'\bIV\b', r'\bIVF\b', r'\bPO\b', r'\bTOPI\b',
+    r'\d+(mg|g|gm|ml|mL|mcg|vial|tab|amp|cap|iu)\b']
+
+def rule_is_med(name, text):
+    if name.startswith('.'):
+        return False
+    if re.search(r'\b(B|U|S|BV)\b|\b(B|U|S|BV)\s*\*:EMR', text):
+        return False
+    return any(re.search(pattern, text, re.IGNORECASE) for pattern in MED_FEATURES)
+
+# 原本以 regex 切出 A/P 段、再以編號切病名的解析
+def rule_parse_soap(soap_text):
+    a_match = re.search(r'(?:^|\n)\s*A\s*:(.*?)(?=(?:^|\n)\s*P\s*:|\Z)', soap_text, re.DOTALL | re.IGNORECASE)
+    p_match = re.search(r'(?:^|\n)\s*P\s*:(.*?)\Z', soap_text, re.DOTALL | re.IGNORECASE)
+    a_text = a_match.group(1).strip() if a_match else ""
+    p_text = p_match.group(1).strip() if p_match else ""
+    problems = []
+    if a_text:
+        for item in re.split(r'\n(?=\d+\.\s)', '\n' + a_text):
+            item = item.strip()
+            if item:
+                problems.append({'title': item.split('\n')[0].strip(), 'full_content': item})
+    return problems, p_text
+
+CLASSIFIER_TOKENS = [
+    "B", "BV", "U", "S", "b", "s", "BS", "U2", "B *:EMR", "S*:EMR", "q8h", "Q12H", "Q30M", "Q", "QD", "qd", "BID",
+    "TID", "QID", "ONCE", "PRN", "IV", "IVF", "IVP", "PO", "POx", "TOPI", "20mg", "1g", "5GM", "10ml", "2mL", "50mcg",
+    "1vial", "2tab", "1amp", "3cap", "100iu", "mg", "20 mg", "1.5g", "x", "_", "-", "/", "(", ")", " ", "  ", "\n", "3天",
+]
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_text_matches_rule_list(seed):
+    rng = random.Random(seed)
+    for _ in range(20000):
+        text = "".join(rng.choice(CLASSIFIER_TOKENS) + rng.choice(("", " ")) for _ in range(rng.randint(0, 8)))
+        name = rng.choice(("Furosemide", ".Sodium chloride"))
+        entry = c.LogEntry("2024/01/01 08:00", text)
+        entry.name, entry.details = name, text
+        assert c.classify_entry(entry).is_med == rule_is_med(name, text), (name, text)
+
+def test_synthetic_log_entries_match_rule_list():
+    entries = c.classify_entries(c.parse_logs_from_lines(generate_log_lines(20000, 3)))
+    assert any(e.is_med for e in entries) and not all(e.is_med for e in entries)
+    for entry in entries:
+        assert entry.is_med == rule_is_med(entry.name, entry.details + " " + " ".join(entry.notes)), entry.raw_line
+
+SOAP_TOKENS = [
+    "A:", "a :", "P:", "p\n:", "A\n:", " A:", "\n", "\n\n", "  ", "1. Foo", "2.\tBar", "10. Baz", "3.x", "[Exam]",
+    "- item", "Plan:", "AP:", "S:", "O:", "x", "　", "\r\n", "12.", "1. ", "\nP", "A", ":",
+]
+
+def parsed_fields(soap_text):
+    problems, p_text = c.parse_historical_soap(soap_text)
+    return [{'title': p['title'], 'full_content': p['full_content']} for p in problems], p_text
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_soap_text_matches_regex_parser(seed):
+    rng = random.Random(seed)
+    for _ in range(20000):
+        text = "".join(rng.choice(SOAP_TOKENS) + rng.choice(("\n", " ", "")) for _ in range(rng.randint(0, 25)))
+        assert parsed_fields(text) == rule_parse_soap(text), text
+
+def test_synthetic_soap_matches_regex_parser():
+    for n in (1, 10, 50, 300):
+        text = generate_soap(n, n)
+        assert parsed_fields(text) == rule_parse_soap(text)
@@ -0,0 +1,52 @@
+import soap_core as c
+from soap_synth import generate_log_lines, generate_soap
+
+def committed_session(log_text):
+    session = c.SoapSession()
+    session.load_soap(*c.parse_historical_soap(generate_soap(3)))
+    session.load_logs(c.build_log_aggregator([log_text]))
+    for item_type in ('med', 'other'):
+        for item in list(session.order_pool(item_type)):
+            session.stage_item(item_type, item, "[Current Management]" if item_type == 'med' else "[Exam]")
+    session.commit(session.hist_probs[0]['title'], c.format_staged_updates(session.staged))
+    session.push()
+    return session
+
+def test_resume_does_not_resurface_committed_orders(tmp_path):
+    log_a = "\n".join(generate_log_lines(2000, 1, 1))
+    log_b = "\n".join(generate_log_lines(2000, 2, 8))
+    store = c.PatientStore(str(tmp_path / "patients.db"))
+    try:
+        session = committed_session(log_a)
+        session.save(store, "P001", session.final_text, session.plan_text())
+        stored = store.load("P001")
+        assert stored["pending"] == (set(), set())
+
+        # 同一份 log 重新上傳：high-water 那一分鐘會被重新解析，但內容相同不應回到未分配清單
+        session = c.SoapSession()
+        session.resume(stored, [log_a])
+        assert not session.has_unassigned()
+
+        session = c.SoapSession()
+        session.resume(store.load("P001"), [log_a + "\n" + log_b])
+        full = c.build_log_aggregator([log_a + "\n" + log_b])
+        assert session.log_aggregator.results() == full.results()
+        assert session.has_unassigned()
+    finally:
+        store.close()
+
+def test_older_log_keeps_high_water(tmp_path):
+    # 最新的一筆是檢查 (非藥物)；較舊的追加 log 不可讓 high-water mark 倒退
+    newer = "\n".join(["列印時間:2024/01/03 08:00", "NEW Furosemide 20mg IV QD   3天",
+                       "列印時間:2024/01/05 08:00", "Chest X-ray portable  AP view"])
+    older = "\n".join(["列印時間:2024/01/01 08:00", "Chest X-ray portable"])
+    store = c.PatientStore(str(tmp_path / "patients.db"))
+    try:
+        session = committed_session(newer)
+        session.ingest_more_logs([older])
+        assert session.log_aggregator.high_water() == 202401050800
+        session.save(store, "P001", session.final_text, session.plan_text())
+        assert store.info("P001")["high_water"] == store.load("P001")["high_water"] == 202401050800
+        assert store.info("P002") is None
+    finally:
+        store.close()